@@ -0,0 +1,72 @@
+"""
+Replace the AED data with the AEDs from a local OSM file, without using Overpass.
+
+Supports .osm.pbf extracts and planet files. Diff updates take over from the file timestamp afterwards.
+
+Usage: python aed_import.py <path>
+"""
+
+import argparse
+import logging
+import os
+from asyncio import run, to_thread
+from collections.abc import AsyncIterator, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from config import PLANET_REPLICA_URL
+from models.osm_node import OSMNode
+from osm_pbf import decode_defibrillators, iter_blobs, read_header
+from services.aed_service import AEDService
+
+_BATCH_SIZE = 10_000
+
+
+def _read_pbf(path: Path) -> tuple[list[OSMNode], float, int | None]:
+    with path.open('rb') as file:
+        header = read_header(file)
+        if header.replication_timestamp is None:
+            raise ValueError('Missing replication timestamp in the file header')
+
+        # sequence numbers are only meaningful for the planet minutely stream
+        sequence_number = (
+            header.replication_sequence_number
+            if (header.replication_base_url or '').rstrip('/') == PLANET_REPLICA_URL.rstrip('/')
+            else None
+        )
+
+        workers = os.process_cpu_count() or 1
+        blobs = (blob for blob_type, blob in iter_blobs(file) if blob_type == 'OSMData')
+
+        with ProcessPoolExecutor(workers) as executor:
+            nodes = [
+                node
+                for block_nodes in executor.map(decode_defibrillators, blobs, buffersize=workers * 2)
+                for node in block_nodes
+            ]
+
+    return nodes, header.replication_timestamp, sequence_number
+
+
+async def _iter_batches(nodes: Sequence[OSMNode]) -> AsyncIterator[Sequence[OSMNode]]:
+    for i in range(0, len(nodes), _BATCH_SIZE):
+        yield nodes[i : i + _BATCH_SIZE]
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description='Replace the AED data with the AEDs from a local OSM file.')
+    parser.add_argument('path', type=Path, help='.osm.pbf file')
+    path: Path = parser.parse_args().path
+
+    # a diff only holds the changed nodes, it cannot replace the whole table
+    if not path.name.endswith('.pbf'):
+        parser.error('Unsupported file type, expected .osm.pbf')
+
+    logging.info('Reading AEDs from %s', path)
+    nodes, data_timestamp, sequence_number = await to_thread(_read_pbf, path)
+    count = await AEDService.import_snapshot(_iter_batches(nodes), data_timestamp, sequence_number)
+    logging.info('AED import finished (=%d)', count)
+
+
+if __name__ == '__main__':
+    run(main())
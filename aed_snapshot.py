@@ -0,0 +1,138 @@
+import logging
+import shutil
+import time
+from asyncio import to_thread
+from typing import NamedTuple
+
+import numpy as np
+
+from config import AED_SNAPSHOT_CHECK_INTERVAL, AED_SNAPSHOT_DIR
+from utils import write_atomic
+
+# The primary worker publishes each version into its own directory, then switches the pointer file.
+# Workers memory-map the arrays read-only, so all processes share a single copy in the page cache.
+
+_POINTER_PATH = AED_SNAPSHOT_DIR / 'current'
+
+
+class AEDSnapshot(NamedTuple):
+    version: int
+    aed_id: np.ndarray  # int64
+    aed_position: np.ndarray  # float64, (lon, lat) pairs
+    aed_access: np.ndarray  # uint32, index into access_values
+    access_values: np.ndarray  # str
+    country_code: np.ndarray  # str, sorted
+    country_count: np.ndarray  # int64, AEDs per country_code
+
+    def count_by_country_code(self, country_code: str) -> int:
+        i = np.searchsorted(self.country_code, country_code)
+        if i < len(self.country_code) and self.country_code[i] == country_code:
+            return int(self.country_count[i])
+        return 0
+
+
+_snapshot: AEDSnapshot | None = None
+_last_check = 0.0
+_pointer_mtime = 0
+
+
+async def get() -> AEDSnapshot | None:
+    """
+    Get the current snapshot, or None if none was published yet.
+
+    The pointer is checked at most once per interval, new versions are switched to atomically.
+    """
+    global _snapshot, _last_check
+
+    now = time.monotonic()
+    if now - _last_check < AED_SNAPSHOT_CHECK_INTERVAL.total_seconds():
+        return _snapshot
+    _last_check = now
+
+    _snapshot = await to_thread(_refresh, _snapshot)
+    return _snapshot
+
+
+def publish(
+    aed_id: np.ndarray,
+    aed_position: np.ndarray,
+    aed_access: np.ndarray,
+    access_values: np.ndarray,
+    country_code: np.ndarray,
+    country_count: np.ndarray,
+) -> int:
+    """
+    Publish a new snapshot version, removing the versions before the previous one.
+
+    Returns the new version.
+    """
+    version = time.time_ns()
+    path = AED_SNAPSHOT_DIR / str(version)
+    temp_path = AED_SNAPSHOT_DIR / f'.{version}'
+    temp_path.mkdir(parents=True)
+
+    arrays = {
+        'aed_id': aed_id,
+        'aed_position': aed_position,
+        'aed_access': aed_access,
+        'access_values': access_values,
+        'country_code': country_code,
+        'country_count': country_count,
+    }
+    for name, array in arrays.items():
+        np.save(temp_path / f'{name}.npy', np.ascontiguousarray(array), allow_pickle=False)
+
+    temp_path.rename(path)
+
+    try:
+        previous = int(_POINTER_PATH.read_text())
+    except FileNotFoundError:
+        previous = None
+
+    write_atomic(_POINTER_PATH, str(version).encode())
+
+    # mapped files stay valid after removal, keeping the previous version covers workers that are switching
+    for p in AED_SNAPSHOT_DIR.iterdir():
+        if p.is_dir() and p.name not in {str(version), str(previous)}:
+            shutil.rmtree(p, ignore_errors=True)
+
+    logging.info('Published AED snapshot %d (=%d)', version, len(aed_id))
+    return version
+
+
+def _refresh(snapshot: AEDSnapshot | None) -> AEDSnapshot | None:
+    global _pointer_mtime
+
+    # the pointer is only read after it was replaced, most checks are a single stat
+    try:
+        mtime = _POINTER_PATH.stat().st_mtime_ns
+    except FileNotFoundError:
+        return snapshot
+    if mtime == _pointer_mtime:
+        return snapshot
+
+    try:
+        version = int(_POINTER_PATH.read_text())
+    except FileNotFoundError:
+        return snapshot
+
+    if snapshot is None or snapshot.version != version:
+        try:
+            snapshot = _load(version)
+        except FileNotFoundError:
+            # superseded while switching, the next check picks up the newer version
+            logging.debug('AED snapshot %d is gone', version)
+            return snapshot
+
+    _pointer_mtime = mtime
+    return snapshot
+
+
+def _load(version: int) -> AEDSnapshot:
+    path = AED_SNAPSHOT_DIR / str(version)
+    arrays = {
+        name: np.load(path / f'{name}.npy', mmap_mode='r', allow_pickle=False)
+        for name in AEDSnapshot._fields
+        if name != 'version'
+    }
+    return AEDSnapshot(version=version, **arrays)
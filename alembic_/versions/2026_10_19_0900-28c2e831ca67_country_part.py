@@ -0,0 +1,42 @@
+"""Country part
+
+Revision ID: 28c2e831ca67
+Revises: 2f0c5a9d3f13
+Create Date: 2026-10-19 09:00:00.000000+00:00
+
+"""
+
+from collections.abc import Sequence
+
+import sqlalchemy as sa
+from alembic import op
+
+import models.geometry
+
+# revision identifiers, used by Alembic.
+revision: str = '28c2e831ca67'
+down_revision: str | None = '2f0c5a9d3f13'
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'country_part',
+        sa.Column('country_code', sa.Unicode(length=8), nullable=False),
+        sa.Column('part', sa.BigInteger(), nullable=False),
+        sa.Column('geometry', models.geometry.GeometryType(), nullable=False),
+        sa.PrimaryKeyConstraint('country_code', 'part'),
+    )
+    op.execute(
+        """
+        INSERT INTO "country_part" ("country_code", "part", "geometry")
+        SELECT "country"."code", s."part", s."geometry"
+        FROM "country", ST_Subdivide("country"."geometry", 256) WITH ORDINALITY AS s("geometry", "part")
+        """
+    )
+    op.create_index('country_part_geometry_idx', 'country_part', ['geometry'], unique=False, postgresql_using='gist')
+
+
+def downgrade() -> None:
+    pass
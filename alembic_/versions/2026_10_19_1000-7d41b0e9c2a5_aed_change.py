@@ -0,0 +1,44 @@
+"""AED change
+
+Revision ID: 7d41b0e9c2a5
+Revises: 28c2e831ca67
+Create Date: 2026-10-19 10:00:00.000000+00:00
+
+"""
+
+from collections.abc import Sequence
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+import models.geometry
+
+# revision identifiers, used by Alembic.
+revision: str = '7d41b0e9c2a5'
+down_revision: str | None = '28c2e831ca67'
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'aed_change',
+        sa.Column('id', sa.BigInteger(), sa.Identity(always=False), nullable=False),
+        sa.Column('aed_id', sa.BigInteger(), nullable=False),
+        sa.Column('version', sa.BigInteger(), nullable=True),
+        sa.Column('tags', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+        sa.Column('position', models.geometry.PointType(), nullable=True),
+        sa.Column(
+            'created_at',
+            postgresql.TIMESTAMP(timezone=True),
+            server_default=sa.text('statement_timestamp()'),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('aed_change_created_at_idx', 'aed_change', ['created_at'], unique=False)
+
+
+def downgrade() -> None:
+    pass
@@ -0,0 +1,60 @@
+"""OSM edit job
+
+Revision ID: 9b3f6a1d4c27
+Revises: 7d41b0e9c2a5
+Create Date: 2026-10-19 11:00:00.000000+00:00
+
+"""
+
+from collections.abc import Sequence
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = '9b3f6a1d4c27'
+down_revision: str | None = '7d41b0e9c2a5'
+branch_labels: str | Sequence[str] | None = None
+depends_on: str | Sequence[str] | None = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'osm_edit_job',
+        sa.Column('id', sa.Unicode(length=32), nullable=False),
+        sa.Column('node_id', sa.BigInteger(), nullable=False),
+        sa.Column('photo_id', sa.Unicode(length=32), nullable=True),
+        sa.Column('tags', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+        sa.Column('access_token', sa.Unicode(length=255), nullable=True),
+        sa.Column('status', sa.Unicode(length=16), nullable=False),
+        sa.Column('attempts', sa.SmallInteger(), nullable=False),
+        sa.Column(
+            'next_attempt_at',
+            postgresql.TIMESTAMP(timezone=True),
+            server_default=sa.text('statement_timestamp()'),
+            nullable=False,
+        ),
+        sa.Column('changeset_id', sa.BigInteger(), nullable=True),
+        sa.Column('uploaded', sa.Boolean(), nullable=False),
+        sa.Column('error', sa.UnicodeText(), nullable=True),
+        sa.Column(
+            'created_at',
+            postgresql.TIMESTAMP(timezone=True),
+            server_default=sa.text('statement_timestamp()'),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index(
+        'osm_edit_job_pending_idx',
+        'osm_edit_job',
+        ['next_attempt_at'],
+        unique=False,
+        postgresql_where=sa.text("status = 'pending'"),
+    )
+    op.create_index('osm_edit_job_created_at_idx', 'osm_edit_job', ['created_at'], unique=False)
+
+
+def downgrade() -> None:
+    pass
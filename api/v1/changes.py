@@ -0,0 +1,50 @@
+from datetime import timedelta
+from typing import Annotated
+
+from fastapi import APIRouter, HTTPException, Query
+from shapely import get_coordinates
+
+from config import AED_CHANGE_PAGE_SIZE
+from middlewares.cache_control_middleware import cache_control
+from middlewares.skip_serialization import skip_serialization
+from services.aed_change_service import AEDChangeService
+
+router = APIRouter()
+
+
+@router.get('/changes')
+@cache_control(timedelta(minutes=1), stale=timedelta(minutes=5))
+@skip_serialization()
+async def get_changes(since: Annotated[int, Query(ge=0)]):
+    """
+    Get the AED changes after the given sequence.
+
+    Clients start from the sequence of the downloaded dataset, then keep polling for changes.
+    """
+    result = await AEDChangeService.get_since(since, AED_CHANGE_PAGE_SIZE)
+    if result is None:
+        raise HTTPException(410, 'Changes are no longer available, download the full dataset again')
+
+    changes, sequence = result
+    return {
+        'sequence': sequence,
+        'changes': [
+            {
+                'sequence': change.id,
+                '@osm_type': 'node',
+                '@osm_id': change.aed_id,
+                'deleted': True,
+            }
+            if change.position is None
+            else {
+                'sequence': change.id,
+                '@osm_type': 'node',
+                '@osm_id': change.aed_id,
+                '@osm_version': change.version,
+                'coordinates': get_coordinates(change.position)[0].tolist(),
+                'tags': change.tags,
+            }
+            for change in changes
+        ],
+        'more': len(changes) >= AED_CHANGE_PAGE_SIZE,
+    }
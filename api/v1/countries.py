@@ -61,12 +61,14 @@ async def get_names(language: str | None = None):
 })
 async def get_geojson(country_code: Annotated[str, Path(min_length=2, max_length=5)]):
     if country_code == 'WORLD':
-        aeds = await AEDService.get_all()
+        aeds, sequence = await AEDService.get_all()
     else:
-        aeds = await AEDService.get_by_country_code(country_code)
+        aeds, sequence = await AEDService.get_by_country_code(country_code)
 
     return {
         'type': 'FeatureCollection',
+        # cached together with the data, clients poll the changes after it
+        'sequence': sequence,
         'features': [
             {
                 'type': 'Feature',
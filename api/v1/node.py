@@ -11,7 +11,7 @@ from middlewares.cache_control_middleware import cache_control
 from middlewares.skip_serialization import skip_serialization
 from services.aed_service import AEDService
 from services.photo_service import PhotoService
-from utils import get_wikimedia_commons_url
+from utils import get_wikimedia_commons_title, get_wikimedia_commons_url
 
 router = APIRouter()
 
@@ -40,7 +40,7 @@ async def _get_image_data(tags: dict[str, str]) -> dict:
         image_url
         and (photo_id_match := _photo_id_re.search(image_url))
         and (photo_id := photo_id_match.group('id'))
-        and (await PhotoService.get_by_id(photo_id)) is not None
+        and (await PhotoService.get_file_path(photo_id)) is not None
     ):
         return {
             '@photo_id': photo_id,
@@ -55,10 +55,7 @@ async def _get_image_data(tags: dict[str, str]) -> dict:
             '@photo_source': image_url,
         }
 
-    if (
-        (wikimedia_commons := tags.get('wikimedia_commons', '').partition(';')[0])  #
-        and wikimedia_commons[:4].casefold() != 'http'
-    ):
+    if wikimedia_commons := get_wikimedia_commons_title(tags):
         return {
             '@photo_id': None,
             '@photo_url': f'/api/v1/photos/proxy/wikimedia-commons/{quote_plus(wikimedia_commons)}',
@@ -1,62 +1,52 @@
 import json
 from datetime import timedelta
-from io import BytesIO
 from typing import Annotated
 from urllib.parse import unquote_plus
 
 import magic
-from bs4 import BeautifulSoup, Tag
-from fastapi import APIRouter, File, Form, HTTPException, Request, Response, UploadFile
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, File, Form, Request, Response, UploadFile
+from fastapi.responses import FileResponse, StreamingResponse
 from feedgen.feed import FeedGenerator
 from pydantic import SecretStr
+from starlette.background import BackgroundTask
 
-from config import IMAGE_CONTENT_TYPES, IMAGE_REMOTE_MAX_FILE_SIZE
+from config import IMAGE_CONTENT_TYPES, IMAGE_THUMBNAIL_WIDTHS, WIKIMEDIA_COMMONS_THUMBNAIL_WIDTH
 from middlewares.cache_control_middleware import cache_control
 from openstreetmap import OpenStreetMap, osm_user_has_active_block
-from osm_change import update_node_tags_osm_change
 from services.aed_service import AEDService
+from services.osm_edit_job_service import OSMEditJobService
+from services.photo_proxy_service import PhotoProxyService, PhotoProxyStream
 from services.photo_report_service import PhotoReportService
 from services.photo_service import PhotoService
-from utils import HTTP, get_wikimedia_commons_url
+from services.wikimedia_commons_service import WikimediaCommonsService
 
 router = APIRouter(prefix='/photos')
 
 
-async def _fetch_image(url: str) -> tuple[bytes, str]:
-    async with HTTP.stream('GET', url) as r:
-        r.raise_for_status()
-
-        # Early detection of unsupported types
-        content_type = r.headers.get('Content-Type')
-        if content_type and content_type not in IMAGE_CONTENT_TYPES:
-            raise HTTPException(500, f'Unsupported file type {content_type!r}, must be one of {IMAGE_CONTENT_TYPES}')
-
-        with BytesIO() as buffer:
-            async for chunk in r.aiter_bytes(1024 * 1024):
-                buffer.write(chunk)
-                if buffer.tell() > IMAGE_REMOTE_MAX_FILE_SIZE:
-                    raise HTTPException(
-                        500, f'File is too large, max allowed size is {IMAGE_REMOTE_MAX_FILE_SIZE} bytes'
-                    )
-            file = buffer.getvalue()
-
-    # Check if file type is supported
-    content_type = magic.from_buffer(file[:2048], mime=True)
-    if content_type not in IMAGE_CONTENT_TYPES:
-        raise HTTPException(500, f'Unsupported file type {content_type!r}, must be one of {IMAGE_CONTENT_TYPES}')
-
-    return file, content_type
+def _stream_response(stream: PhotoProxyStream) -> StreamingResponse:
+    # the stream is cached on disk once complete, keep it out of the shared response cache
+    return StreamingResponse(
+        stream,
+        media_type=stream.content_type,
+        headers={'Cache-Control': f'private, max-age={int(timedelta(days=7).total_seconds())}'},
+        background=BackgroundTask(stream.save),
+    )
 
 
 @router.get('/view/{id}.webp')
 @cache_control(timedelta(days=365), stale=timedelta(days=365))
-async def view(id: str):
-    photo = await PhotoService.get_by_id(id)
-    if photo is None:
+async def view(id: str, w: int | None = None):
+    if w is not None and w not in IMAGE_THUMBNAIL_WIDTHS:
+        return Response(f'Unsupported width {w}, must be one of {sorted(IMAGE_THUMBNAIL_WIDTHS)}', 400)
+
+    file_path = await PhotoService.get_file_path(id)
+    if file_path is None:
         return Response(f'Photo {id!r} not found', 404)
 
-    return FileResponse(photo.file_path)
+    if w is not None:
+        return FileResponse(await PhotoService.get_thumbnail_path(file_path, w), media_type='image/webp')
+
+    return FileResponse(file_path)
 
 
 @router.get('/proxy/direct/{url_encoded:path}')
@@ -68,28 +58,33 @@ async def proxy_direct(url_encoded: str):
     if not url.lower().startswith(('https://', 'http://')):
         url = unquote_plus(url)
 
-    file, content_type = await _fetch_image(url)
-    return Response(file, media_type=content_type)
+    cached = await PhotoProxyService.get_cached(url)
+    if cached is not None:
+        return FileResponse(cached[0], media_type=cached[1])
+
+    stream = await PhotoProxyService.open(url, url)
+    return _stream_response(stream)
 
 
 @router.get('/proxy/wikimedia-commons/{path_encoded:path}')
 @cache_control(timedelta(days=7), stale=timedelta(days=7))
-async def proxy_wikimedia_commons(path_encoded: str):
-    meta_url = get_wikimedia_commons_url(unquote_plus(path_encoded))
-    r = await HTTP.get(meta_url)
-    r.raise_for_status()
+async def proxy_wikimedia_commons(path_encoded: str, w: int | None = None):
+    if w is not None and w not in IMAGE_THUMBNAIL_WIDTHS:
+        return Response(f'Unsupported width {w}, must be one of {sorted(IMAGE_THUMBNAIL_WIDTHS)}', 400)
 
-    bs = BeautifulSoup(r.text, 'lxml')
-    og_image = bs.find('meta', property='og:image')
-    if not isinstance(og_image, Tag):
-        return Response('Missing og:image meta tag', 404)
+    width = w or WIKIMEDIA_COMMONS_THUMBNAIL_WIDTH
+    title = unquote_plus(path_encoded)
+    source = f'wikimedia-commons:{width}:{title}'
+    cached = await PhotoProxyService.get_cached(source)
+    if cached is not None:
+        return FileResponse(cached[0], media_type=cached[1])
 
-    image_url = og_image['content']
-    if not isinstance(image_url, str):
-        return Response('Invalid og:image meta tag (expected str)', 404)
+    image_url = await WikimediaCommonsService.get_image_url(title, width)
+    if image_url is None:
+        return Response(f'File {title!r} not found on Wikimedia Commons', 404)
 
-    file, content_type = await _fetch_image(image_url)
-    return Response(file, media_type=content_type)
+    stream = await PhotoProxyService.open(source, image_url)
+    return _stream_response(stream)
 
 
 @router.post('/upload')
@@ -136,20 +131,32 @@ async def upload(
     user_id = osm_user['id']
     photo = await PhotoService.upload(node_id, user_id, file)
     photo_url = f'{request.base_url}api/v1/photos/view/{photo.id}.webp'
-    node_xml = await osm.get_node_xml(node_id)
-    if node_xml is None:
-        return Response(f'Node {node_id} not found on remote', 404)
 
-    osm_change = update_node_tags_osm_change(
-        node_xml,
+    # the OSM edit is made in the background, clients poll the job status,
+    # and the photo is deleted there if the node no longer exists on remote
+    job = await OSMEditJobService.create(
+        node_id,
         {
             'image': photo_url,
             'image:license': file_license,
         },
+        oauth2_token,
+        photo_id=photo.id,
     )
+    return {'photo_id': photo.id, 'job_id': job.id}
+
+
+@router.get('/upload/{job_id}')
+async def upload_status(job_id: str):
+    job = await OSMEditJobService.get_by_id(job_id)
+    if job is None:
+        return Response(f'Upload job {job_id!r} not found', 404)
 
-    await osm.upload_osm_change(osm_change)
-    return True
+    return {
+        'status': job.status,
+        'changeset_id': job.changeset_id,
+        'error': job.error,
+    }
 
 
 @router.post('/report')
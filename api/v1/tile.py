@@ -8,6 +8,7 @@ import numpy as np
 from fastapi import APIRouter, Path, Response
 from sentry_sdk import start_span, trace
 from shapely import get_coordinates, points, set_coordinates, simplify
+from starlette.background import BackgroundTask
 
 from config import (
     DEFAULT_CACHE_MAX_AGE,
@@ -26,7 +27,8 @@ from models.db.aed import AED
 from models.db.country import Country
 from services.aed_service import AEDService
 from services.country_service import CountryService
-from utils import abbreviate
+from services.wikimedia_commons_service import WikimediaCommonsService
+from utils import abbreviate, get_wikimedia_commons_title
 
 router = APIRouter()
 
@@ -53,6 +55,7 @@ async def get_tile(
     y: Annotated[int, Path(ge=0)],
 ):
     bbox = _tile_to_bbox(z, x, y)
+    background = None
 
     # no-transform:
     # https://community.cloudflare.com/t/cloudflare-is-decompressing-my-mapbox-vector-tiles/278031/2
@@ -61,10 +64,18 @@ async def get_tile(
         content = await _get_tile_country(z, bbox)
         cache_control = make_cache_control(TILE_COUNTRIES_CACHE_MAX_AGE, TILE_COUNTRIES_CACHE_STALE) + ', no-transform'
     else:
-        content = await _get_tile_aed(z, bbox)
+        content, wikimedia_commons_titles = await _get_tile_aed(z, bbox)
+        if wikimedia_commons_titles:
+            # resolve the photos of the visible AEDs before they are opened
+            background = BackgroundTask(WikimediaCommonsService.prewarm, wikimedia_commons_titles)
         cache_control = make_cache_control(DEFAULT_CACHE_MAX_AGE, TILE_AEDS_CACHE_STALE) + ', no-transform'
 
-    return Response(content, headers={'Cache-Control': cache_control}, media_type='application/vnd.mapbox-vector-tile')
+    return Response(
+        content,
+        headers={'Cache-Control': cache_control},
+        media_type='application/vnd.mapbox-vector-tile',
+        background=background,
+    )
 
 
 def _mvt_encode(bbox: BBox, layers: Sequence[dict]) -> bytes:
@@ -157,11 +168,21 @@ async def _get_tile_country(z: int, bbox: BBox) -> bytes:
 
 
 @trace
-async def _get_tile_aed(z: int, bbox: BBox) -> bytes:
+async def _get_tile_aed(z: int, bbox: BBox) -> tuple[bytes, list[str]]:
+    """
+    Encode the AED tile, also returning the Wikimedia Commons photos of the individual AEDs.
+    """
     group_eps = 9.6 / 2**z if z < TILE_MAX_Z else None
     aeds = await AEDService.get_intersecting(bbox.extend(0.5), group_eps)
 
-    return _mvt_encode(
+    # the image tag takes precedence, see node._get_image_data
+    wikimedia_commons_titles = [
+        title
+        for aed in aeds
+        if isinstance(aed, AED) and not aed.tags.get('image') and (title := get_wikimedia_commons_title(aed.tags))
+    ]
+
+    content = _mvt_encode(
         bbox,
         [
             {
@@ -188,3 +209,5 @@ async def _get_tile_aed(z: int, bbox: BBox) -> bytes:
             }
         ],
     )
+
+    return content, wikimedia_commons_titles
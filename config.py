@@ -24,11 +24,21 @@ DEFAULT_CACHE_STALE = timedelta(minutes=5)
 
 COUNTRY_GEOJSON_URL = 'https://osm-countries-geojson.monicz.dev/osm-countries-0-01.geojson.zst'
 COUNTRY_UPDATE_DELAY = timedelta(days=float(os.getenv('COUNTRY_UPDATE_DELAY', '1')))
+COUNTRY_SUBDIVIDE_MAX_VERTICES = 256
 AED_UPDATE_DELAY = timedelta(seconds=30)
-AED_REBUILD_THRESHOLD = timedelta(hours=1)
-
-PLANET_REPLICA_URL = 'https://planet.openstreetmap.org/replication/minute/'
-PLANET_DIFF_TIMEOUT = timedelta(minutes=5)
+AED_REBUILD_THRESHOLD = timedelta(days=3)
+AED_CHANGE_RETENTION = timedelta(days=30)
+AED_CHANGE_PAGE_SIZE = 10_000
+AED_SNAPSHOT_CHECK_INTERVAL = timedelta(seconds=1)
+AED_SNAPSHOT_PUBLISH_INTERVAL = timedelta(seconds=30)  # minimum time between publishes
+
+PLANET_REPLICA_URL = os.getenv('PLANET_REPLICA_URL', 'https://planet.openstreetmap.org/replication/minute/')
+# root of the hour and day streams, used to catch up larger lags
+PLANET_REPLICA_ROOT_URL = os.getenv('PLANET_REPLICA_ROOT_URL', PLANET_REPLICA_URL.removesuffix('minute/'))
+PLANET_DIFF_TIMEOUT = timedelta(minutes=30)
+PLANET_DIFF_DOWNLOAD_CONCURRENCY = 4
+PLANET_DIFF_CACHE_MAX_SIZE = 512 * 1024 * 1024  # 512 MB
+PLANET_DIFF_CACHE_PRUNE_INTERVAL = timedelta(hours=1)
 
 TILE_COUNTRIES_CACHE_MAX_AGE = timedelta(hours=4)
 TILE_COUNTRIES_CACHE_STALE = timedelta(days=7)
@@ -40,6 +50,17 @@ TILE_MAX_Z = 16
 
 OVERPASS_API_URL = os.getenv('OVERPASS_API_URL', 'https://overpass-api.de/api/interpreter')
 OPENSTREETMAP_API_URL = os.getenv('OPENSTREETMAP_API_URL', 'https://api.openstreetmap.org/api/0.6/')
+OSM_USER_CACHE_EXPIRE = timedelta(minutes=5)
+OSM_EDIT_JOB_POLL_INTERVAL = timedelta(seconds=5)
+OSM_EDIT_JOB_RETRY_DELAY = timedelta(seconds=30)  # doubled after each failed attempt
+OSM_EDIT_JOB_MAX_ATTEMPTS = 10
+OSM_EDIT_JOB_RETENTION = timedelta(days=7)
+
+WIKIMEDIA_COMMONS_API_URL = 'https://commons.wikimedia.org/w/api.php'
+WIKIMEDIA_COMMONS_THUMBNAIL_WIDTH = 1280
+WIKIMEDIA_COMMONS_CACHE_EXPIRE = timedelta(days=30)
+WIKIMEDIA_COMMONS_MISSING_CACHE_EXPIRE = timedelta(days=1)
+WIKIMEDIA_COMMONS_PREWARM_EXPIRE = timedelta(hours=1)
 
 DEFAULT_CHANGESET_TAGS = {
     'comment': 'Updated AED image',
@@ -58,9 +79,36 @@ IMAGE_CONTENT_TYPES = {'image/jpeg', 'image/jpg', 'image/png', 'image/webp'}
 IMAGE_LIMIT_PIXELS = 6 * 1000 * 1000  # 6 MP (e.g., 3000x2000)
 IMAGE_MAX_FILE_SIZE = 2 * 1024 * 1024  # 2 MB
 IMAGE_REMOTE_MAX_FILE_SIZE = 10 * 1024 * 1024  # 10 MB
+IMAGE_PROCESSING_WORKERS = 4
+IMAGE_PROCESSING_CONCURRENCY = 2  # uploads processed at once, the rest wait
+IMAGE_PROCESSING_QUEUE_SIZE = 8  # uploads waiting for processing, more are rejected
+IMAGE_PROCESSING_QUEUE_TIMEOUT = timedelta(seconds=30)
+IMAGE_TRANSCODE_CONCURRENCY = 1  # proxied images transcoded at once, the rest are cached as they are
+IMAGE_THUMBNAIL_WIDTHS = frozenset((160, 320, 640, 1280))
+IMAGE_THUMBNAIL_QUALITY = 80
+IMAGE_THUMBNAIL_CONCURRENCY = 1  # thumbnails generated at once, the rest wait
+IMAGE_THUMBNAIL_QUEUE_SIZE = 16  # thumbnails waiting for generation, more are rejected
+IMAGE_PROXY_LIMIT_PIXELS = 2 * 1000 * 1000  # 2 MP
+IMAGE_PROXY_MAX_FILE_SIZE = 300 * 1024  # 300 KB
+PHOTO_INDEX_MEMORY_SIZE = 50_000  # photo paths kept in memory per worker
+PHOTO_INDEX_MEMORY_EXPIRE = timedelta(minutes=5)  # removals made by other workers show up after this
+PHOTO_INDEX_REBUILD_INTERVAL = timedelta(hours=6)  # picks up files removed outside the app
+
+# re-encode proxied images as downscaled WebPs, instead of passing the originals through
+PHOTO_PROXY_TRANSCODE = os.getenv('PHOTO_PROXY_TRANSCODE', '1').strip().lower() in ('1', 'true', 'yes')
+PHOTO_PROXY_CACHE_MAX_SIZE = 2 * 1024 * 1024 * 1024  # 2 GB
+PHOTO_PROXY_CACHE_EXPIRE = timedelta(days=14)
+PHOTO_PROXY_CACHE_PRUNE_INTERVAL = timedelta(minutes=5)
 
 DATA_DIR = Path('data')
 PHOTOS_DIR = Path('data/photos')
+PHOTO_THUMBNAILS_DIR = Path('data/photo-thumbnails')
+PHOTO_PROXY_CACHE_DIR = Path('data/photo-proxy-cache')
+AED_SNAPSHOT_DIR = Path('data/aed-snapshot')
+PLANET_DIFF_CACHE_DIR = Path('data/planet-diffs')
+
+# apply replication files from a local directory (same layout as the replica) instead of the network
+PLANET_DIFF_REPLAY_DIR = Path(replay_dir) if (replay_dir := os.getenv('PLANET_DIFF_REPLAY_DIR')) else None
 
 # Logging configuration
 dictConfig({
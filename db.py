@@ -1,8 +1,11 @@
 from asyncio import AbstractEventLoop, get_running_loop
+from collections.abc import AsyncIterable, Iterable, Sequence
 from contextlib import asynccontextmanager
 from weakref import WeakKeyDictionary
 
+from sqlalchemy import MetaData, Table, text
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.schema import CreateIndex
 from valkey.asyncio import ConnectionPool, Valkey
 
 from config import POSTGRES_URL, VALKEY_URL
@@ -42,6 +45,74 @@ async def db_write():
         await session.commit()
 
 
+async def db_copy_records(
+    session: AsyncSession,
+    table_name: str,
+    columns: Sequence[str],
+    records: Iterable[Sequence] | AsyncIterable[Sequence],
+) -> None:
+    """
+    Bulk load records into a table using the binary COPY protocol, within the session transaction.
+    """
+    connection = await session.connection()
+    raw_connection = await connection.get_raw_connection()
+    await raw_connection.driver_connection.copy_records_to_table(  # pyright: ignore[reportOptionalMemberAccess]
+        table_name,
+        records=records,
+        columns=columns,
+    )
+
+
+async def db_create_temporary_table(session: AsyncSession, table: Table) -> None:
+    """
+    Create a temporary table within the session transaction.
+    """
+    connection = await session.connection()
+    await connection.run_sync(table.create)
+
+
+async def db_create_shadow_table(session: AsyncSession, table: Table) -> Table:
+    """
+    Create an empty copy of the table, without indexes, to load a replacement into.
+    """
+    shadow = table.to_metadata(MetaData(), name=f'{table.name}_new')
+    await session.execute(text(f'DROP TABLE IF EXISTS "{shadow.name}"'))
+    await session.execute(text(f'CREATE TABLE "{shadow.name}" (LIKE "{table.name}" INCLUDING DEFAULTS)'))
+    return shadow
+
+
+async def db_swap_shadow_table(session: AsyncSession, table: Table, shadow: Table) -> None:
+    """
+    Index and analyze the loaded shadow table, then swap it in place of the live one.
+
+    Readers are only blocked for the renames at the end. The swap becomes visible
+    on commit, so a failed rebuild leaves the live table untouched.
+    """
+    index_names: dict[str, str] = {}
+
+    primary_key_name = f'{shadow.name}_pkey'
+    primary_key_columns = ', '.join(f'"{column.name}"' for column in shadow.primary_key.columns)
+    await session.execute(
+        text(f'ALTER TABLE "{shadow.name}" ADD CONSTRAINT "{primary_key_name}" PRIMARY KEY ({primary_key_columns})')
+    )
+    index_names[primary_key_name] = f'{table.name}_pkey'
+
+    for index in shadow.indexes:
+        name = str(index.name)
+        index.name = f'{shadow.name}{name.removeprefix(table.name)}'  # pyright: ignore[reportAttributeAccessIssue]
+        await session.execute(CreateIndex(index))
+        index_names[index.name] = name
+
+    await session.execute(text(f'ANALYZE "{shadow.name}"'))
+
+    await session.execute(text(f'ALTER TABLE "{table.name}" RENAME TO "{table.name}_old"'))
+    await session.execute(text(f'ALTER TABLE "{shadow.name}" RENAME TO "{table.name}"'))
+    await session.execute(text(f'DROP TABLE "{table.name}_old" CASCADE'))
+
+    for shadow_name, name in index_names.items():
+        await session.execute(text(f'ALTER INDEX "{shadow_name}" RENAME TO "{name}"'))
+
+
 _valkey_pools: WeakKeyDictionary[AbstractEventLoop, ConnectionPool] = WeakKeyDictionary()
 
 
@@ -9,6 +9,7 @@ from fastapi import APIRouter, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from starlette_compress import CompressMiddleware
 
+import photo_storage
 from json_response import JSONResponseUTF8
 from middlewares.cache_control_middleware import CacheControlMiddleware
 from middlewares.cache_response_middleware import CacheResponseMiddleware
@@ -16,6 +17,8 @@ from middlewares.profiler_middleware import ProfilerMiddleware
 from middlewares.version_middleware import VersionMiddleware
 from services.aed_service import AEDService
 from services.country_service import CountryService
+from services.osm_edit_job_service import OSMEditJobService
+from services.photo_service import PhotoService
 from services.worker_service import WorkerService
 
 
@@ -31,11 +34,19 @@ async def lifespan(_):
             aed_started = Event()
             aed_task = tg.create_task(AEDService.update_db_task(aed_started))
             await aed_started.wait()
+            aed_snapshot_task = tg.create_task(AEDService.publish_snapshot_task())
+            osm_edit_job_task = tg.create_task(OSMEditJobService.process_task())
+            await photo_storage.migrate_flat_layout()
+            await PhotoService.build_index()
+            photo_index_task = tg.create_task(PhotoService.build_index_task())
 
             await worker_state.set_state('running')
             yield
 
             # on shutdown, always abort the tasks
+            photo_index_task.cancel()
+            osm_edit_job_task.cancel()
+            aed_snapshot_task.cancel()
             aed_task.cancel()
             country_task.cancel()
     else:
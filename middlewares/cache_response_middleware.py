@@ -1,4 +1,5 @@
 import logging
+from collections.abc import Collection
 from compression.zstd import compress, decompress
 from datetime import UTC, datetime, timedelta
 from io import BytesIO
@@ -165,6 +166,10 @@ class CachingResponder:
         if not cache_control:
             return
 
+        # this is a shared cache, private responses are only for the requesting client
+        if 'private' in cache_control:
+            return
+
         headers['Age'] = '0'
         headers['X-Cache'] = 'MISS'
         max_age, stale = parse_cache_control(cache_control)
@@ -201,3 +206,27 @@ async def _set_cached_response(key: str, cached: CachedResponse) -> None:
 
     async with valkey() as conn:
         await conn.set(key, value, ex=ttl)
+
+
+@trace
+async def invalidate_cached_responses(paths: Collection[str]) -> int:
+    """
+    Remove the cached responses of the given paths, across all encoding variants and query strings.
+
+    Returns the number of removed entries.
+    """
+    if not paths:
+        return 0
+
+    async with valkey() as conn:
+        keys: list[bytes] = [
+            key
+            async for key in conn.scan_iter(match='cache3:*', count=1000)
+            # cache3:{variant}:{path}:{query}
+            if key.split(b':', 3)[2].decode() in paths
+        ]
+        if keys:
+            await conn.unlink(*keys)
+
+    logging.debug('Invalidated %d cached responses', len(keys))
+    return len(keys)
@@ -0,0 +1,33 @@
+from shapely import Point
+from sqlalchemy import BigInteger, Identity, Index
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import Mapped, mapped_column
+
+from models.db.base import Base
+from models.db.created_at_mixin import CreatedAtMixin
+from models.geometry import PointType
+
+
+class AEDChange(Base, CreatedAtMixin):
+    """
+    Applied AED change, in the order of the monotonically increasing id.
+
+    Deletions have no version, tags, or position.
+    """
+
+    __tablename__ = 'aed_change'
+
+    id: Mapped[int] = mapped_column(
+        BigInteger,
+        Identity(),
+        init=False,
+        nullable=False,
+        primary_key=True,
+    )
+
+    aed_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    version: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
+    tags: Mapped[dict[str, str] | None] = mapped_column(JSONB, nullable=True)
+    position: Mapped[Point | None] = mapped_column(PointType, nullable=True)
+
+    __table_args__ = (Index('aed_change_created_at_idx', 'created_at'),)
@@ -0,0 +1,29 @@
+from shapely import MultiPolygon, Polygon
+from sqlalchemy import BigInteger, Index, Unicode
+from sqlalchemy.orm import Mapped, mapped_column
+
+from models.db.base import Base
+from models.geometry import GeometryType
+
+
+class CountryPart(Base):
+    """
+    Subdivided piece of a country geometry, for fast point-in-country tests.
+    """
+
+    __tablename__ = 'country_part'
+
+    country_code: Mapped[str] = mapped_column(
+        Unicode(8),
+        nullable=False,
+        primary_key=True,
+    )
+    part: Mapped[int] = mapped_column(
+        BigInteger,
+        nullable=False,
+        primary_key=True,
+    )
+
+    geometry: Mapped[Polygon | MultiPolygon] = mapped_column(GeometryType, nullable=False)
+
+    __table_args__ = (Index('country_part_geometry_idx', geometry, postgresql_using='gist'),)
@@ -0,0 +1,54 @@
+import secrets
+from datetime import datetime
+from typing import Literal
+
+from sqlalchemy import BigInteger, Boolean, Index, SmallInteger, Unicode, UnicodeText, func
+from sqlalchemy.dialects.postgresql import JSONB, TIMESTAMP
+from sqlalchemy.orm import Mapped, mapped_column
+
+from models.db.base import Base
+from models.db.created_at_mixin import CreatedAtMixin
+
+OSMEditJobStatus = Literal['pending', 'done', 'failed']
+
+
+class OSMEditJob(Base, CreatedAtMixin):
+    """
+    Pending or finished node tags update on OpenStreetMap, processed by the primary worker.
+
+    The access token is only kept while the job is pending.
+    The uploaded photo, if any, is deleted when the node turns out not to exist.
+    The changeset is recorded as soon as it is created, so a retry can tell which steps are done.
+    """
+
+    __tablename__ = 'osm_edit_job'
+
+    id: Mapped[str] = mapped_column(
+        Unicode(32),
+        init=False,
+        nullable=False,
+        primary_key=True,
+        default=lambda: secrets.token_urlsafe(16),
+    )
+
+    node_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    tags: Mapped[dict[str, str]] = mapped_column(JSONB, nullable=False)
+    access_token: Mapped[str | None] = mapped_column(Unicode(255), nullable=True)
+    photo_id: Mapped[str | None] = mapped_column(Unicode(32), nullable=True, default=None)
+
+    status: Mapped[OSMEditJobStatus] = mapped_column(Unicode(16), nullable=False, default='pending')
+    attempts: Mapped[int] = mapped_column(SmallInteger, nullable=False, default=0)
+    next_attempt_at: Mapped[datetime] = mapped_column(
+        TIMESTAMP(True),
+        init=False,
+        nullable=False,
+        server_default=func.statement_timestamp(),
+    )
+    changeset_id: Mapped[int | None] = mapped_column(BigInteger, nullable=True, default=None)
+    uploaded: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
+    error: Mapped[str | None] = mapped_column(UnicodeText, nullable=True, default=None)
+
+    __table_args__ = (
+        Index('osm_edit_job_pending_idx', next_attempt_at, postgresql_where=status == 'pending'),
+        Index('osm_edit_job_created_at_idx', 'created_at'),
+    )
@@ -4,9 +4,9 @@ from pathlib import Path
 from sqlalchemy import BigInteger, Unicode
 from sqlalchemy.orm import Mapped, mapped_column
 
-from config import PHOTOS_DIR
 from models.db.base import Base
 from models.db.created_at_mixin import CreatedAtMixin
+from photo_storage import get_photo_path
 
 
 class Photo(Base, CreatedAtMixin):
@@ -25,4 +25,4 @@ class Photo(Base, CreatedAtMixin):
 
     @property
     def file_path(self) -> Path:
-        return PHOTOS_DIR / f'{self.user_id}_{self.node_id}_{self.id}.webp'
+        return get_photo_path(self.user_id, self.node_id, self.id)
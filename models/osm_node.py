@@ -0,0 +1,9 @@
+from typing import NamedTuple
+
+
+class OSMNode(NamedTuple):
+    id: int
+    version: int
+    tags: dict[str, str]
+    lon: float
+    lat: float
@@ -1,11 +1,15 @@
+import json
 import logging
+from hashlib import blake2b
 
 import xmltodict
+from httpx import Response
 from pydantic import SecretStr
 from sentry_sdk import trace
 from starlette import status
 
-from config import CHANGESET_ID_PLACEHOLDER, DEFAULT_CHANGESET_TAGS, OPENSTREETMAP_API_URL
+from config import CHANGESET_ID_PLACEHOLDER, DEFAULT_CHANGESET_TAGS, OPENSTREETMAP_API_URL, OSM_USER_CACHE_EXPIRE
+from db import valkey
 from utils import HTTP, retry_exponential
 from xmltodict_postprocessor import xmltodict_postprocessor
 
@@ -17,10 +21,39 @@ def osm_user_has_active_block(user: dict) -> bool:
 class OpenStreetMap:
     def __init__(self, access_token: SecretStr):
         self.access_token: SecretStr = access_token
+        token_hash = blake2b(access_token.get_secret_value().encode(), digest_size=16).hexdigest()
+        self._user_cache_key = f'osm-user:{token_hash}'
 
-    @retry_exponential(10)
     @trace
     async def get_authorized_user(self) -> dict | None:
+        """
+        Get the user owning the access token, or None if the token is invalid.
+
+        Only the user id and the block status are kept, cached briefly by token hash,
+        so consecutive uploads by the same user skip the remote call.
+        """
+        async with valkey() as conn:
+            cached: bytes | None = await conn.get(self._user_cache_key)
+
+        if cached is not None:
+            return json.loads(cached)
+
+        user = await self._fetch_authorized_user()
+        if user is None:
+            return None
+
+        user = {
+            'id': user['id'],
+            'blocks': {'received': {'active': user['blocks']['received']['active']}},
+        }
+
+        async with valkey() as conn:
+            await conn.set(self._user_cache_key, json.dumps(user), ex=OSM_USER_CACHE_EXPIRE)
+
+        return user
+
+    @retry_exponential(10)
+    async def _fetch_authorized_user(self) -> dict | None:
         r = await HTTP.get(
             f'{OPENSTREETMAP_API_URL}user/details.json',
             headers={'Authorization': f'Bearer {self.access_token.get_secret_value()}'},
@@ -30,6 +63,13 @@ class OpenStreetMap:
         r.raise_for_status()
         return r.json()['user']
 
+    async def _raise_for_status(self, r: Response) -> None:
+        if r.status_code == status.HTTP_401_UNAUTHORIZED:
+            # the token was revoked or expired, the cached user must not authorize further requests
+            async with valkey() as conn:
+                await conn.delete(self._user_cache_key)
+        r.raise_for_status()
+
     @retry_exponential(10)
     @trace
     async def get_node_xml(self, node_id: int) -> dict | None:
@@ -44,7 +84,7 @@ class OpenStreetMap:
         )['osm']['node']
 
     @trace
-    async def upload_osm_change(self, osm_change: str) -> str:
+    async def create_changeset(self) -> int:
         changeset = xmltodict.unparse({
             'osm': {'changeset': {'tag': [{'@k': k, '@v': v} for k, v in DEFAULT_CHANGESET_TAGS.items()]}}
         })
@@ -57,12 +97,14 @@ class OpenStreetMap:
             },
             content=changeset,
         )
-        r.raise_for_status()
-        changeset_id = r.text
+        await self._raise_for_status(r)
+        return int(r.text)
 
-        osm_change = osm_change.replace(CHANGESET_ID_PLACEHOLDER, changeset_id)
-        logging.info('Uploading changeset %s', changeset_id)
-        logging.info('https://www.openstreetmap.org/changeset/%s', changeset_id)
+    @trace
+    async def upload_osm_change(self, changeset_id: int, osm_change: str) -> None:
+        osm_change = osm_change.replace(CHANGESET_ID_PLACEHOLDER, str(changeset_id))
+        logging.info('Uploading changeset %d', changeset_id)
+        logging.info('https://www.openstreetmap.org/changeset/%d', changeset_id)
 
         r = await HTTP.post(
             f'{OPENSTREETMAP_API_URL}changeset/{changeset_id}/upload',
@@ -72,12 +114,15 @@ class OpenStreetMap:
             },
             content=osm_change,
         )
-        r.raise_for_status()
+        await self._raise_for_status(r)
 
+    @trace
+    async def close_changeset(self, changeset_id: int) -> None:
         r = await HTTP.put(
             f'{OPENSTREETMAP_API_URL}changeset/{changeset_id}/close',
             headers={'Authorization': f'Bearer {self.access_token.get_secret_value()}'},
         )
-        r.raise_for_status()
-
-        return changeset_id
+        if r.status_code == status.HTTP_409_CONFLICT:
+            # already closed, e.g., by an attempt whose response was lost
+            return
+        await self._raise_for_status(r)
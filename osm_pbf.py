@@ -0,0 +1,290 @@
+import struct
+import zlib
+from collections.abc import Iterator
+from compression import zstd
+from typing import Any, BinaryIO, NamedTuple
+
+from models.osm_node import OSMNode
+
+_BLOB_HEADER_SIZE = struct.Struct('>I')
+
+# field numbers, see https://wiki.openstreetmap.org/wiki/PBF_Format
+_BLOB_HEADER_TYPE = 1
+_BLOB_HEADER_DATASIZE = 3
+_BLOB_RAW = 1
+_BLOB_ZLIB_DATA = 3
+_BLOB_ZSTD_DATA = 7
+_HEADER_REQUIRED_FEATURES = 4
+_HEADER_REPLICATION_TIMESTAMP = 32
+_HEADER_REPLICATION_SEQUENCE_NUMBER = 33
+_HEADER_REPLICATION_BASE_URL = 34
+_BLOCK_STRINGTABLE = 1
+_BLOCK_PRIMITIVEGROUP = 2
+_BLOCK_GRANULARITY = 17
+_BLOCK_LAT_OFFSET = 19
+_BLOCK_LON_OFFSET = 20
+_GROUP_NODES = 1
+_GROUP_DENSE = 2
+_NODE_ID = 1
+_NODE_KEYS = 2
+_NODE_VALS = 3
+_NODE_INFO = 4
+_NODE_LAT = 8
+_NODE_LON = 9
+_INFO_VERSION = 1
+_DENSE_ID = 1
+_DENSE_INFO = 5
+_DENSE_LAT = 8
+_DENSE_LON = 9
+_DENSE_KEYS_VALS = 10
+
+_SUPPORTED_FEATURES = frozenset(('OsmSchema-V0.6', 'DenseNodes'))
+
+
+class PBFHeader(NamedTuple):
+    replication_timestamp: int | None
+    replication_sequence_number: int | None
+    replication_base_url: str | None
+
+
+def read_header(file: BinaryIO) -> PBFHeader:
+    """
+    Read the OSMHeader block at the start of the file.
+    """
+    blob = next(iter_blobs(file), None)
+    if blob is None or blob[0] != 'OSMHeader':
+        raise ValueError('Missing OSMHeader block')
+
+    timestamp = sequence_number = base_url = None
+
+    for field, value in _iter_fields(_decompress_blob(blob[1])):
+        if field == _HEADER_REQUIRED_FEATURES:
+            feature = value.decode()
+            if feature not in _SUPPORTED_FEATURES:
+                raise ValueError(f'Unsupported required feature {feature!r}')
+        elif field == _HEADER_REPLICATION_TIMESTAMP:
+            timestamp = value
+        elif field == _HEADER_REPLICATION_SEQUENCE_NUMBER:
+            sequence_number = value
+        elif field == _HEADER_REPLICATION_BASE_URL:
+            base_url = value.decode()
+
+    return PBFHeader(timestamp, sequence_number, base_url)
+
+
+def iter_blobs(file: BinaryIO) -> Iterator[tuple[str, bytes]]:
+    """
+    Iterate over the (still compressed) blobs of the file, with their types.
+
+    Blobs are self-contained, so they can be decoded in parallel.
+    """
+    while header_size_data := file.read(_BLOB_HEADER_SIZE.size):
+        (header_size,) = _BLOB_HEADER_SIZE.unpack(header_size_data)
+        blob_type = ''
+        data_size = 0
+
+        for field, value in _iter_fields(file.read(header_size)):
+            if field == _BLOB_HEADER_TYPE:
+                blob_type = value.decode()
+            elif field == _BLOB_HEADER_DATASIZE:
+                data_size = value
+
+        yield blob_type, file.read(data_size)
+
+
+def decode_defibrillators(blob: bytes) -> list[OSMNode]:
+    """
+    Decode the defibrillator nodes of an OSMData blob.
+    """
+    block = _decompress_blob(blob)
+    strings: list[bytes] = []
+    groups: list[bytes] = []
+    granularity = 100
+    lat_offset = lon_offset = 0
+
+    for field, value in _iter_fields(block):
+        if field == _BLOCK_STRINGTABLE:
+            strings = [s for _, s in _iter_fields(value)]
+        elif field == _BLOCK_PRIMITIVEGROUP:
+            groups.append(value)
+        elif field == _BLOCK_GRANULARITY:
+            granularity = value
+        elif field == _BLOCK_LAT_OFFSET:
+            lat_offset = _int64(value)
+        elif field == _BLOCK_LON_OFFSET:
+            lon_offset = _int64(value)
+
+    # most blocks can be skipped without decoding a single element
+    try:
+        emergency_key = strings.index(b'emergency')
+        defibrillator_value = strings.index(b'defibrillator')
+    except ValueError:
+        return []
+
+    result: list[OSMNode] = []
+
+    def make_node(node_id: int, version: int, keys_vals: list[tuple[int, int]], lat: int, lon: int) -> None:
+        if (emergency_key, defibrillator_value) not in keys_vals:
+            return
+        result.append(
+            OSMNode(
+                id=node_id,
+                version=version,
+                tags={strings[k].decode(): strings[v].decode() for k, v in keys_vals},
+                lon=(lon_offset + granularity * lon) / 1e9,
+                lat=(lat_offset + granularity * lat) / 1e9,
+            )
+        )
+
+    for group in groups:
+        for field, value in _iter_fields(group):
+            if field == _GROUP_DENSE:
+                _decode_dense_nodes(value, make_node)
+            elif field == _GROUP_NODES:
+                _decode_node(value, make_node)
+
+    return result
+
+
+def _decode_dense_nodes(data: bytes, make_node) -> None:
+    ids: list[int] = []
+    lats: list[int] = []
+    lons: list[int] = []
+    keys_vals: list[int] = []
+    versions: list[int] = []
+
+    for field, value in _iter_fields(data):
+        if field == _DENSE_ID:
+            ids = _unpack_varints(value, signed=True)
+        elif field == _DENSE_LAT:
+            lats = _unpack_varints(value, signed=True)
+        elif field == _DENSE_LON:
+            lons = _unpack_varints(value, signed=True)
+        elif field == _DENSE_KEYS_VALS:
+            keys_vals = _unpack_varints(value)
+        elif field == _DENSE_INFO:
+            for info_field, info_value in _iter_fields(value):
+                if info_field == _INFO_VERSION:
+                    versions = _unpack_varints(info_value)
+
+    if not keys_vals:
+        return  # no node has tags
+
+    node_id = lat = lon = 0
+    i = 0
+
+    for n in range(len(ids)):
+        # ids and coordinates are delta-coded
+        node_id += ids[n]
+        lat += lats[n]
+        lon += lons[n]
+
+        node_keys_vals: list[tuple[int, int]] = []
+        while keys_vals[i]:
+            node_keys_vals.append((keys_vals[i], keys_vals[i + 1]))
+            i += 2
+        i += 1
+
+        if node_keys_vals:
+            make_node(node_id, versions[n] if versions else 0, node_keys_vals, lat, lon)
+
+
+def _decode_node(data: bytes, make_node) -> None:
+    node_id = lat = lon = version = 0
+    keys: list[int] = []
+    vals: list[int] = []
+
+    for field, value in _iter_fields(data):
+        if field == _NODE_ID:
+            node_id = _zigzag(value)
+        elif field == _NODE_KEYS:
+            keys = _unpack_varints(value)
+        elif field == _NODE_VALS:
+            vals = _unpack_varints(value)
+        elif field == _NODE_INFO:
+            for info_field, info_value in _iter_fields(value):
+                if info_field == _INFO_VERSION:
+                    version = info_value
+        elif field == _NODE_LAT:
+            lat = _zigzag(value)
+        elif field == _NODE_LON:
+            lon = _zigzag(value)
+
+    if keys:
+        make_node(node_id, version, list(zip(keys, vals, strict=True)), lat, lon)
+
+
+def _decompress_blob(blob: bytes) -> bytes:
+    for field, value in _iter_fields(blob):
+        if field == _BLOB_RAW:
+            return value
+        if field == _BLOB_ZLIB_DATA:
+            return zlib.decompress(value)
+        if field == _BLOB_ZSTD_DATA:
+            return zstd.decompress(value)
+
+    raise ValueError('Unsupported blob compression')
+
+
+def _iter_fields(data: bytes) -> Iterator[tuple[int, Any]]:
+    """
+    Iterate over the (field number, value) pairs of a protobuf message.
+
+    Varints are returned as unsigned integers, length-delimited fields as bytes.
+    """
+    pos = 0
+    end = len(data)
+
+    while pos < end:
+        key, pos = _read_varint(data, pos)
+        wire_type = key & 0x7
+
+        if wire_type == 0:  # varint
+            value, pos = _read_varint(data, pos)
+        elif wire_type == 2:  # length-delimited
+            length, pos = _read_varint(data, pos)
+            value = data[pos : pos + length]
+            pos += length
+        elif wire_type == 1:  # 64-bit
+            value = int.from_bytes(data[pos : pos + 8], 'little')
+            pos += 8
+        elif wire_type == 5:  # 32-bit
+            value = int.from_bytes(data[pos : pos + 4], 'little')
+            pos += 4
+        else:
+            raise ValueError(f'Unsupported protobuf wire type {wire_type}')
+
+        yield key >> 3, value
+
+
+def _read_varint(data: bytes, pos: int) -> tuple[int, int]:
+    result = 0
+    shift = 0
+
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _unpack_varints(data: bytes, *, signed: bool = False) -> list[int]:
+    result: list[int] = []
+    pos = 0
+    end = len(data)
+
+    while pos < end:
+        value, pos = _read_varint(data, pos)
+        result.append(_zigzag(value) if signed else value)
+
+    return result
+
+
+def _int64(value: int) -> int:
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _zigzag(value: int) -> int:
+    return (value >> 1) ^ -(value & 1)
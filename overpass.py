@@ -1,32 +1,114 @@
-from collections.abc import Sequence
+import json
+import re
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
 from datetime import UTC, datetime
 
-from sentry_sdk import trace
-
 from config import OVERPASS_API_URL
-from utils import HTTP, retry_exponential
+from utils import HTTP
+
+_TIMESTAMP_RE = re.compile(r'"timestamp_osm_base"\s*:\s*"([^"]+)"')
+_REMARK_RE = re.compile(r'"remark"\s*:\s*"((?:[^"\\]|\\.)*)"')
+_SEPARATOR_RE = re.compile(r'[\s,]*')
+
 
+@asynccontextmanager
+async def stream_overpass(
+    query: str,
+    *,
+    timeout: int,  # noqa: ASYNC109
+    batch_size: int = 10_000,
+) -> AsyncIterator[tuple[float, AsyncIterator[list[dict]]]]:
+    """
+    Run an Overpass query, streaming the returned elements in batches.
 
-@retry_exponential(None)
-@trace
-async def query_overpass(query: str, *, timeout: int, must_return: bool = False) -> tuple[Sequence[dict], float]:  # noqa: ASYNC109
+    Yields the data timestamp and an iterator over element batches,
+    so peak memory is bounded by the batch size rather than the response size.
+    """
     join = '' if query.startswith('[') else ';'
     query = f'[out:json][timeout:{timeout}]{join}{query}'
 
-    r = await HTTP.post(OVERPASS_API_URL, data={'data': query}, timeout=timeout * 2)
-    r.raise_for_status()
-    data = r.json()
+    async with HTTP.stream('POST', OVERPASS_API_URL, data={'data': query}, timeout=timeout * 2) as r:
+        r.raise_for_status()
+        reader = _ElementReader(r.aiter_text())
+        data_timestamp = await reader.read_header()
+        yield data_timestamp, reader.iter_batches(batch_size)
+
+
+class _ElementReader:
+    """
+    Incremental reader for the elements array of an Overpass JSON response.
+    """
+
+    __slots__ = ('_buffer', '_chunks', '_decoder', '_pos')
+
+    def __init__(self, chunks: AsyncIterator[str]) -> None:
+        self._chunks = chunks
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+
+    async def _fill(self) -> bool:
+        chunk = await anext(self._chunks, None)
+        if chunk is None:
+            return False
+        self._buffer = self._buffer[self._pos :] + chunk
+        self._pos = 0
+        return True
+
+    async def read_header(self) -> float:
+        while (elements_pos := self._buffer.find('"elements"')) == -1 or (
+            array_pos := self._buffer.find('[', elements_pos)
+        ) == -1:
+            if not await self._fill():
+                raise ValueError('Missing elements in Overpass response')
+
+        match = _TIMESTAMP_RE.search(self._buffer, 0, elements_pos)
+        if match is None:
+            raise ValueError('Missing timestamp in Overpass response')
+
+        self._pos = array_pos + 1
+        return datetime.strptime(match.group(1), '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=UTC).timestamp()
+
+    async def iter_elements(self) -> AsyncIterator[dict]:
+        while True:
+            self._pos = _SEPARATOR_RE.match(self._buffer, self._pos).end()  # pyright: ignore[reportOptionalMemberAccess]
+
+            if self._pos >= len(self._buffer):
+                if not await self._fill():
+                    raise ValueError('Unexpected end of Overpass response')
+                continue
+
+            if self._buffer[self._pos] == ']':
+                self._pos += 1
+                break
+
+            try:
+                element, self._pos = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                # the element continues in the next chunk
+                if not await self._fill():
+                    raise
+                continue
+
+            yield element
+
+        # runtime errors are reported after the (truncated) elements
+        rest = self._buffer[self._pos :] + ''.join([chunk async for chunk in self._chunks])
+        match = _REMARK_RE.search(rest)
+        if match is not None:
+            remark: str = json.loads(f'"{match.group(1)}"')
+            if remark.startswith('runtime error'):
+                raise ValueError(f'Overpass query failed: {remark}')
 
-    data_timestamp = (
-        datetime.strptime(
-            data['osm3s']['timestamp_osm_base'],
-            '%Y-%m-%dT%H:%M:%SZ',
-        )
-        .replace(tzinfo=UTC)
-        .timestamp()
-    )
+    async def iter_batches(self, batch_size: int) -> AsyncIterator[list[dict]]:
+        batch: list[dict] = []
 
-    if must_return and not data['elements']:
-        raise ValueError('No elements returned')
+        async for element in self.iter_elements():
+            batch.append(element)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
 
-    return data['elements'], data_timestamp
+        if batch:
+            yield batch
@@ -0,0 +1,84 @@
+import logging
+from asyncio import to_thread
+from hashlib import blake2b
+from pathlib import Path
+
+from config import PHOTO_THUMBNAILS_DIR, PHOTOS_DIR
+from utils import write_atomic
+
+# Photos are spread over 256 shard directories, so no single directory grows with the photo count.
+# All file operations run in threads, keeping slow disks from blocking the event loop.
+
+
+def get_photo_path(user_id: int, node_id: int, id: str) -> Path:
+    return PHOTOS_DIR / _get_shard(id) / f'{user_id}_{node_id}_{id}.webp'
+
+
+def get_thumbnail_path(path: Path, width: int) -> Path:
+    return PHOTO_THUMBNAILS_DIR / path.parent.name / f'{path.stem}_{width}.webp'
+
+
+async def write(path: Path, data: bytes) -> None:
+    """
+    Write the file atomically, readers never see partial content.
+    """
+    await to_thread(write_atomic, path, data)
+
+
+async def delete(path: Path) -> None:
+    """
+    Delete the photo and all of its thumbnails.
+    """
+    await to_thread(_delete, path)
+
+
+async def is_file(path: Path) -> bool:
+    return await to_thread(path.is_file)
+
+
+async def list_photos() -> set[str]:
+    """
+    List the stored photos, as paths relative to PHOTOS_DIR.
+    """
+    return await to_thread(_list_photos)
+
+
+async def migrate_flat_layout() -> None:
+    """
+    Move the files stored directly in PHOTOS_DIR and PHOTO_THUMBNAILS_DIR into their shard directories.
+    """
+    if moved := await to_thread(_migrate_flat_layout):
+        logging.info('Moved %d photo files into shard directories', moved)
+
+
+def _get_shard(id: str) -> str:
+    return blake2b(id.encode(), digest_size=1).hexdigest()
+
+
+def _delete(path: Path) -> None:
+    path.unlink(missing_ok=True)
+    for thumbnail in (PHOTO_THUMBNAILS_DIR / path.parent.name).glob(f'{path.stem}_*.webp'):
+        thumbnail.unlink(missing_ok=True)
+
+
+def _list_photos() -> set[str]:
+    return {path.relative_to(PHOTOS_DIR).as_posix() for path in PHOTOS_DIR.glob('*/*.webp')}
+
+
+def _migrate_flat_layout() -> int:
+    moved = 0
+
+    for directory in (PHOTOS_DIR, PHOTO_THUMBNAILS_DIR):
+        if not directory.is_dir():
+            continue
+
+        for path in directory.glob('*.webp'):
+            # {user_id}_{node_id}_{id}.webp, thumbnails have a _{width} suffix
+            parts = path.stem.split('_')
+            id = '_'.join(parts[2:] if directory == PHOTOS_DIR else parts[2:-1])
+            target = directory / _get_shard(id) / path.name
+            target.parent.mkdir(exist_ok=True)
+            path.replace(target)
+            moved += 1
+
+    return moved
@@ -1,86 +1,161 @@
-import gzip
+import logging
+import os
 import re
-from asyncio import TaskGroup, timeout
+import time
+import zlib
+from array import array
+from asyncio import Semaphore, TaskGroup, timeout, to_thread
 from collections.abc import Sequence
 from datetime import UTC, datetime
-from itertools import chain
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import IO
+from xml.parsers import expat
 
-import xmltodict
+import numpy as np
 from sentry_sdk import start_span, trace
 
-from config import AED_REBUILD_THRESHOLD, PLANET_DIFF_TIMEOUT, PLANET_REPLICA_URL
-from utils import HTTP, retry_exponential
-from xmltodict_postprocessor import xmltodict_postprocessor
+from config import (
+    PLANET_DIFF_CACHE_DIR,
+    PLANET_DIFF_CACHE_MAX_SIZE,
+    PLANET_DIFF_CACHE_PRUNE_INTERVAL,
+    PLANET_DIFF_DOWNLOAD_CONCURRENCY,
+    PLANET_DIFF_REPLAY_DIR,
+    PLANET_DIFF_TIMEOUT,
+    PLANET_REPLICA_ROOT_URL,
+    PLANET_REPLICA_URL,
+)
+from models.osm_node import OSMNode
+from utils import HTTP, prune_cache, retry_exponential
 
-_action_open_re = re.compile(r'<(create|modify|delete)>')
-_action_close_re = re.compile(r'</(create|modify|delete)>')
+_CHUNK_SIZE = 1024 * 1024
+
+_last_prune = 0.0
+
+# replication streams from the coarsest, with the interval between their sequences in seconds
+_STREAMS = (('day', 86400), ('hour', 3600), ('minute', 60))
 
 
 @trace
-async def get_planet_diffs(last_update: float) -> tuple[Sequence[dict], float]:
-    async with timeout(PLANET_DIFF_TIMEOUT.total_seconds()):
-        sequence_numbers = []
-        sequence_timestamps = []
+async def get_planet_diffs(
+    last_update: float, last_sequence_number: int | None, aed_ids: set[int]
+) -> tuple[Sequence[OSMNode], np.ndarray, float, int | None]:
+    """
+    Get the AED nodes changed since the last update.
 
-        while True:
-            next_sequence_number = sequence_numbers[-1] - 1 if sequence_numbers else None
-            sequence_number, sequence_timestamp = await _get_state(next_sequence_number)
+    Returns the created or modified AEDs, the ids of nodes that are no longer AEDs,
+    and the timestamp and minutely sequence number of the data.
 
-            if sequence_timestamp <= last_update:
-                break
+    Only the stored AEDs, given by aed_ids, can be removed, so changes of other nodes are skipped while parsing.
+    The AEDs found in the diffs are added to aed_ids in place.
 
-            sequence_numbers.append(sequence_number)
-            sequence_timestamps.append(sequence_timestamp)
+    Larger lags are first caught up with day and hour diffs, finishing with a minutely tail,
+    so the number of files stays small. Coarse diffs may reach back before the last update,
+    which is harmless because only the most recent version of each node is applied.
+    """
+    async with timeout(PLANET_DIFF_TIMEOUT.total_seconds()):
+        latest_sequence_number, latest_timestamp = await _get_state('minute', None)
 
-        if not sequence_numbers:
-            return (), last_update
+        if latest_timestamp <= last_update:
+            return (), np.empty(0, np.int64), last_update, last_sequence_number
 
-        with start_span(description=f'Processing {len(sequence_numbers)} planet diffs'):
+        diff_paths: list[str] = []
+        cursor = last_update
 
-            @retry_exponential(AED_REBUILD_THRESHOLD)
-            async def _get_planet_diff(sequence_number: int) -> tuple[int, list[dict]]:
-                path = f'{_format_sequence_number(sequence_number)}.osc.gz'
-                r = await HTTP.get(f'{PLANET_REPLICA_URL}{path}')
-                r.raise_for_status()
+        # replayed diffs are applied one minute at a time
+        if PLANET_DIFF_REPLAY_DIR is None:
+            for stream, interval in _STREAMS[:-1]:
+                stream_sequence_number, stream_timestamp = await _get_state(stream, None)
+                if stream_timestamp - cursor < interval:
+                    continue
+                first_sequence_number = await _find_first_sequence_number(
+                    stream, interval, cursor, stream_sequence_number, stream_timestamp
+                )
+                diff_paths.extend(
+                    f'{stream}/{_format_sequence_number(sequence_number)}.osc.gz'
+                    for sequence_number in range(first_sequence_number, stream_sequence_number + 1)
+                )
+                cursor = stream_timestamp
 
-                xml = gzip.decompress(r.content).decode()
-                xml = _format_actions(xml)
-                actions: list[dict] = xmltodict.parse(
-                    xml,
-                    postprocessor=xmltodict_postprocessor,
-                    force_list=('action', 'node', 'way', 'relation', 'member', 'tag', 'nd'),
-                )['osmChange']['action']
+        if last_sequence_number is not None and cursor == last_update:
+            first_sequence_number = last_sequence_number + 1
+        else:
+            first_sequence_number = await _find_first_sequence_number(
+                'minute', _STREAMS[-1][1], cursor, latest_sequence_number, latest_timestamp
+            )
+        diff_paths.extend(
+            f'minute/{_format_sequence_number(sequence_number)}.osc.gz'
+            for sequence_number in range(first_sequence_number, latest_sequence_number + 1)
+        )
 
-                node_actions: list[dict] = []
+        if not diff_paths:
+            return (), np.empty(0, np.int64), last_update, last_sequence_number
 
-                for action in actions:
-                    # ignore everything that is not a node
-                    if 'node' in action:
-                        action.pop('way', None)
-                        action.pop('relation', None)
-                        node_actions.append(action)
+        with start_span(description=f'Processing {len(diff_paths)} planet diffs'):
+            download_limiter = Semaphore(PLANET_DIFF_DOWNLOAD_CONCURRENCY)
 
-                return sequence_number, node_actions
+            @retry_exponential(PLANET_DIFF_TIMEOUT)
+            async def _download_planet_diff(path: str) -> Path:
+                async with download_limiter:
+                    return await _get_replica_file(path)
 
             async with TaskGroup() as tg:
-                tasks = [tg.create_task(_get_planet_diff(sequence_number)) for sequence_number in sequence_numbers]
+                # downloads run ahead, while parsing follows in chronological order,
+                # so a node that becomes an AED is known to the parsers of the later diffs
+                downloads = [tg.create_task(_download_planet_diff(path)) for path in diff_paths]
+                parsers = [await to_thread(_parse_planet_diff, await download, aed_ids) for download in downloads]
+
+        if PLANET_DIFF_REPLAY_DIR is None:
+            await _maybe_prune_cache()
+
+        nodes, remove_ids = _merge_changes(parsers)
+        return nodes, remove_ids, latest_timestamp, latest_sequence_number
 
-        result = [t.result() for t in tasks]
-        result.sort(key=lambda x: x[0])  # sort by sequence number in ascending order
 
-        data = tuple(chain.from_iterable(data for _, data in result))
-        data_timestamp = sequence_timestamps[0]
-        return data, data_timestamp
+async def _find_first_sequence_number(
+    stream: str, interval: int, last_update: float, latest_sequence_number: int, latest_timestamp: float
+) -> int:
+    """
+    Find the first sequence number of the stream published after the given timestamp.
 
+    Sequences are published at a regular interval, so the search starts from an estimate
+    and usually settles after a request or two.
+    """
+    sequence_number = latest_sequence_number - int((latest_timestamp - last_update) // interval)
+    sequence_number = min(max(sequence_number, 0), latest_sequence_number)
 
-@retry_exponential(AED_REBUILD_THRESHOLD)
+    while sequence_number < latest_sequence_number:
+        _, sequence_timestamp = await _get_state(stream, sequence_number)
+        if sequence_timestamp > last_update:
+            break
+        sequence_number += 1
+
+    while sequence_number > 0:
+        _, sequence_timestamp = await _get_state(stream, sequence_number - 1)
+        if sequence_timestamp <= last_update:
+            break
+        sequence_number -= 1
+
+    return sequence_number
+
+
+@retry_exponential(PLANET_DIFF_TIMEOUT)
 @trace
-async def _get_state(sequence_number: int | None) -> tuple[int, float]:
-    path = 'state.txt' if sequence_number is None else f'{_format_sequence_number(sequence_number)}.state.txt'
-    r = await HTTP.get(f'{PLANET_REPLICA_URL}{path}')
-    r.raise_for_status()
+async def _get_state(stream: str, sequence_number: int | None) -> tuple[int, float]:
+    if sequence_number is None and PLANET_DIFF_REPLAY_DIR is None:
+        # the pointer moves with every new sequence, so it is never cached
+        r = await HTTP.get(_get_url(f'{stream}/state.txt'))
+        r.raise_for_status()
+        text = r.text
+    else:
+        path = await _get_replica_file(
+            f'{stream}/state.txt'
+            if sequence_number is None
+            else f'{stream}/{_format_sequence_number(sequence_number)}.state.txt'
+        )
+        text = await to_thread(path.read_text)
 
-    text = r.text.replace('\\:', ':')
+    text = text.replace('\\:', ':')
     sequence_number = int(re.search(r'sequenceNumber=(\d+)', text).group(1))  # pyright: ignore [reportOptionalMemberAccess]
     sequence_date_str = re.search(r'timestamp=(\S+)', text).group(1)  # pyright: ignore [reportOptionalMemberAccess]
     sequence_date = datetime.strptime(sequence_date_str, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=UTC)
@@ -88,16 +163,211 @@ async def _get_state(sequence_number: int | None) -> tuple[int, float]:
     return sequence_number, sequence_timestamp
 
 
+async def _get_replica_file(path: str) -> Path:
+    """
+    Get the local path of a replication file.
+
+    Files come from the replay directory when configured, otherwise from the local cache,
+    falling back to the network. Everything except the state.txt pointer is immutable
+    for a given path, so it is safe to cache by path.
+    """
+    if PLANET_DIFF_REPLAY_DIR is not None:
+        return PLANET_DIFF_REPLAY_DIR / path
+
+    cache_path = PLANET_DIFF_CACHE_DIR / path
+    if await to_thread(_touch, cache_path):
+        return cache_path
+
+    # chunks are written to a temporary file as they arrive, which becomes the cache entry once complete
+    f = await to_thread(_create_temp_file, cache_path)
+    temp_path = Path(f.name)
+    try:
+        with f:
+            async with HTTP.stream('GET', _get_url(path)) as r:
+                r.raise_for_status()
+                async for chunk in r.aiter_bytes(_CHUNK_SIZE):
+                    await to_thread(f.write, chunk)
+            await to_thread(_sync, f)
+        await to_thread(temp_path.replace, cache_path)
+    finally:
+        await to_thread(temp_path.unlink, missing_ok=True)
+
+    return cache_path
+
+
+def _get_url(path: str) -> str:
+    stream, _, stream_path = path.partition('/')
+    if stream == 'minute':
+        return f'{PLANET_REPLICA_URL}{stream_path}'
+    return f'{PLANET_REPLICA_ROOT_URL}{path}'
+
+
+def _parse_planet_diff(path: Path, aed_ids: set[int]) -> _OsmChangeParser:
+    parser = _OsmChangeParser(aed_ids)
+
+    try:
+        with path.open('rb') as f:
+            while chunk := f.read(_CHUNK_SIZE):
+                parser.feed(chunk)
+        parser.close()
+    except zlib.error, expat.ExpatError:
+        # a damaged cache entry would fail every retry, download it again next time
+        if PLANET_DIFF_REPLAY_DIR is None:
+            path.unlink(missing_ok=True)
+        raise
+
+    return parser
+
+
+def _create_temp_file(path: Path) -> IO[bytes]:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return NamedTemporaryFile(dir=path.parent, prefix=f'.{path.name}.', delete=False)
+
+
+def _sync(f: IO[bytes]) -> None:
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _touch(path: Path) -> bool:
+    try:
+        os.utime(path)  # mark as recently used
+    except FileNotFoundError:
+        return False
+    return True
+
+
+async def _maybe_prune_cache() -> None:
+    global _last_prune
+
+    # listing the cache directory is not free, so it is done at most once per interval
+    now = time.monotonic()
+    if now - _last_prune < PLANET_DIFF_CACHE_PRUNE_INTERVAL.total_seconds():
+        return
+    _last_prune = now
+
+    if removed := await to_thread(prune_cache, PLANET_DIFF_CACHE_DIR, PLANET_DIFF_CACHE_MAX_SIZE):
+        logging.debug('Pruned %d planet diff cache files', removed)
+
+
 def _format_sequence_number(sequence_number: int) -> str:
     result = f'{sequence_number:09d}'
     result = '/'.join(result[i : i + 3] for i in range(0, 9, 3))
     return result
 
 
-def _format_actions(xml: str) -> str:
-    # <create> -> <action type="create">
-    # </create> -> </action>
-    # etc.
-    xml = _action_open_re.sub(r'<action type="\1">', xml)
-    xml = _action_close_re.sub(r'</action>', xml)
-    return xml
+class _OsmChangeParser:
+    """
+    Incremental parser for gzip-compressed osmChange documents.
+
+    Only nodes are looked at: created and modified AEDs are collected, and added to aed_ids.
+    Other changes of nodes in aed_ids are recorded as removal candidates.
+    """
+
+    __slots__ = (
+        '_action',
+        '_aed_ids',
+        '_decompressor',
+        '_node',
+        '_parser',
+        '_tags',
+        'nodes',
+        'remove_ids',
+        'remove_versions',
+    )
+
+    def __init__(self, aed_ids: set[int]) -> None:
+        self._aed_ids = aed_ids
+        self._decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        self._parser = expat.ParserCreate()
+        self._parser.StartElementHandler = self._start_element
+        self._parser.EndElementHandler = self._end_element
+        self._action: str | None = None
+        self._node: dict[str, str] | None = None
+        self._tags: dict[str, str] = {}
+        self.nodes: list[OSMNode] = []
+        self.remove_ids = array('q')
+        self.remove_versions = array('q')
+
+    def feed(self, data: bytes) -> None:
+        self._parser.Parse(self._decompressor.decompress(data), False)
+
+    def close(self) -> None:
+        self._parser.Parse(self._decompressor.flush(), True)
+
+    def _start_element(self, name: str, attrs: dict[str, str]) -> None:
+        if name == 'tag':
+            if self._node is not None:
+                self._tags[attrs['k']] = attrs['v']
+        elif name == 'node':
+            if self._action is not None:
+                self._node = attrs
+                self._tags = {}
+        elif name in {'create', 'modify', 'delete'}:
+            self._action = name
+
+    def _end_element(self, name: str) -> None:
+        if name != 'node':
+            if name in {'create', 'modify', 'delete'}:
+                self._action = None
+            return
+
+        node = self._node
+        if node is None:
+            return
+        self._node = None
+
+        node_id = int(node['id'])
+        version = int(node['version'])
+
+        if self._action != 'delete' and self._tags.get('emergency') == 'defibrillator':
+            self.nodes.append(
+                OSMNode(
+                    id=node_id,
+                    version=version,
+                    tags=self._tags,
+                    lon=float(node['lon']),
+                    lat=float(node['lat']),
+                )
+            )
+            self._aed_ids.add(node_id)
+        elif node_id in self._aed_ids:
+            self.remove_ids.append(node_id)
+            self.remove_versions.append(version)
+
+
+def _merge_changes(parsers: Sequence[_OsmChangeParser]) -> tuple[Sequence[OSMNode], np.ndarray]:
+    """
+    Merge the parsed diffs, keeping only the most recent version of each node.
+    """
+    # diffs are in ascending order, but versions are the source of truth
+    id_node_map: dict[int, OSMNode] = {}
+    for parser in parsers:
+        for node in parser.nodes:
+            prev = id_node_map.get(node.id)
+            if prev is None or prev.version < node.version:
+                id_node_map[node.id] = node
+
+    remove_ids = np.concatenate([np.frombuffer(parser.remove_ids, np.int64) for parser in parsers])
+    remove_versions = np.concatenate([np.frombuffer(parser.remove_versions, np.int64) for parser in parsers])
+
+    # keep the highest removal version for each id
+    order = np.lexsort((remove_versions, remove_ids))
+    remove_ids = remove_ids[order]
+    remove_versions = remove_versions[order]
+    last_mask = np.ones(len(remove_ids), bool)
+    last_mask[:-1] = remove_ids[1:] != remove_ids[:-1]
+    remove_ids = remove_ids[last_mask]
+    remove_versions = remove_versions[last_mask]
+
+    # resolve nodes that were both upserted and removed
+    remove_mask = np.ones(len(remove_ids), bool)
+    for node in tuple(id_node_map.values()):
+        i = np.searchsorted(remove_ids, node.id)
+        if i < len(remove_ids) and remove_ids[i] == node.id:
+            if remove_versions[i] > node.version:
+                del id_node_map[node.id]
+            else:
+                remove_mask[i] = False
+
+    return tuple(id_node_map.values()), remove_ids[remove_mask]
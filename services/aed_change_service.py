@@ -0,0 +1,95 @@
+from collections.abc import Sequence
+
+from sentry_sdk import trace
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import AED_CHANGE_RETENTION
+from db import db_read, db_write
+from models.db.aed_change import AEDChange
+from models.db.state import State
+
+
+class AEDChangeService:
+    @staticmethod
+    @trace
+    async def get_since(since: int, limit: int) -> tuple[Sequence[AEDChange], int] | None:
+        """
+        Get the changes after the given sequence, and the latest sequence.
+
+        Returns None when changes after the given sequence are no longer available,
+        because they expired or the data was replaced by a snapshot.
+        """
+        async with db_read() as session:
+            # read the changes before the state: a concurrent prune commits both at once,
+            # so the worst case is a needless reset
+            stmt = select(AEDChange).where(AEDChange.id > since).order_by(AEDChange.id).limit(limit)
+            changes = (await session.scalars(stmt)).all()
+            min_sequence = await _get_min_sequence(session)
+
+        if since < min_sequence:
+            return None
+
+        return changes, (changes[-1].id if changes else since)
+
+    @staticmethod
+    @trace
+    async def get_latest_sequence() -> int:
+        async with db_read() as session:
+            return await AEDChangeService.get_latest_sequence_within(session)
+
+    @staticmethod
+    async def get_latest_sequence_within(session: AsyncSession) -> int:
+        stmt = select(func.max(AEDChange.id))
+        latest: int | None = await session.scalar(stmt)
+        return latest if latest is not None else await _get_min_sequence(session)
+
+    @staticmethod
+    @trace
+    async def prune() -> None:
+        """
+        Remove the changes older than the retention period.
+        """
+        async with db_write() as session:
+            deleted = (
+                delete(AEDChange)
+                .where(AEDChange.created_at < func.statement_timestamp() - AED_CHANGE_RETENTION)
+                .returning(AEDChange.id)
+                .cte('deleted')
+            )
+            stmt = select(func.max(deleted.c.id))
+            max_id: int | None = await session.scalar(stmt)
+            if max_id is not None:
+                await _set_min_sequence(session, max_id)
+
+    @staticmethod
+    @trace
+    async def reset(session: AsyncSession) -> None:
+        """
+        Invalidate all changes, within the session transaction.
+
+        Used when the data is replaced as a whole, so clients have to download it again.
+        """
+        await session.execute(delete(AEDChange))
+        stmt = select(func.nextval(func.pg_get_serial_sequence(AEDChange.__tablename__, 'id')))
+        min_sequence: int = (await session.execute(stmt)).scalar_one()
+        await _set_min_sequence(session, min_sequence)
+
+
+async def _get_min_sequence(session: AsyncSession) -> int:
+    state = await session.get(State, 'aed_change')
+    return state.data['min_sequence'] if (state is not None) else 0
+
+
+async def _set_min_sequence(session: AsyncSession, min_sequence: int) -> None:
+    data = {'min_sequence': min_sequence}
+    stmt = (
+        insert(State)
+        .values({State.key: 'aed_change', State.data: data})
+        .on_conflict_do_update(
+            index_elements=(State.key,),
+            set_={State.data: data},
+        )
+    )
+    await session.execute(stmt)
@@ -1,33 +1,86 @@
+import json
 import logging
-from asyncio import Event, sleep
-from collections.abc import Collection, Iterable, Sequence
-from operator import attrgetter, itemgetter
+from asyncio import Event, sleep, to_thread
+from collections.abc import AsyncIterable, Collection, Iterable, Sequence
 from time import time
 from typing import NoReturn, cast
 
 import numpy as np
 from cachetools import TTLCache
 from sentry_sdk import start_span, start_transaction, trace
-from shapely import Point, get_coordinates, points
+from shapely import Point, box, get_coordinates, intersects_xy, points
 from shapely.geometry.base import BaseGeometry
 from sklearn.cluster import Birch
-from sqlalchemy import any_, delete, func, select, text, update
-from sqlalchemy.dialects.postgresql import array_agg, insert
-
-from config import AED_REBUILD_THRESHOLD, AED_UPDATE_DELAY
-from db import db_read, db_write
+from sqlalchemy import (
+    ARRAY,
+    BigInteger,
+    Column,
+    Double,
+    MetaData,
+    Table,
+    Unicode,
+    any_,
+    delete,
+    func,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.dialects.postgresql import JSONB, array_agg, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+import aed_snapshot
+from config import AED_REBUILD_THRESHOLD, AED_SNAPSHOT_PUBLISH_INTERVAL, AED_UPDATE_DELAY, PLANET_DIFF_REPLAY_DIR
+from db import (
+    db_copy_records,
+    db_create_shadow_table,
+    db_create_temporary_table,
+    db_read,
+    db_swap_shadow_table,
+    db_write,
+)
 from models.aed_group import AEDGroup
 from models.bbox import BBox
 from models.db.aed import AED
-from models.db.country import Country
-from overpass import query_overpass
+from models.db.aed_change import AEDChange
+from models.db.country_part import CountryPart
+from models.osm_node import OSMNode
+from overpass import stream_overpass
 from planet_diffs import get_planet_diffs
+from services.aed_change_service import AEDChangeService
+from services.country_service import CountryService
 from services.state_service import StateService
 from utils import retry_exponential
 
 _COUNTRY_BY_COUNTRY_CODE_CACHE = TTLCache(maxsize=1024, ttl=3600)
 _OVERPASS_QUERY = 'node[emergency=defibrillator];out meta qt;'
 
+_AED_STAGING = Table(
+    'aed_staging',
+    MetaData(),
+    Column('id', BigInteger, nullable=False),
+    Column('version', BigInteger, nullable=False),
+    Column('tags', JSONB, nullable=False),
+    Column('lon', Double, nullable=False),
+    Column('lat', Double, nullable=False),
+    Column('country_codes', ARRAY(Unicode(8), dimensions=1), nullable=True),
+    prefixes=('TEMPORARY',),
+    postgresql_on_commit='DROP',
+)
+_AED_REMOVE_STAGING = Table(
+    'aed_remove_staging',
+    MetaData(),
+    Column('id', BigInteger, nullable=False),
+    prefixes=('TEMPORARY',),
+    postgresql_on_commit='DROP',
+)
+_published_snapshot_key: tuple[int, float | None] | None = None
+_snapshot_outdated = Event()  # set by the updates, the publish task waits for it
+_aed_ids_cache: tuple[float, set[int]] | None = None  # update timestamp, stored AED ids
+_MERGE_COLUMNS = ('id', 'version', 'tags', 'position', 'country_codes')
+_ASSIGN_CHUNK_SIZE = 10_000
+
 
 class AEDService:
     @staticmethod
@@ -41,14 +94,83 @@ class AEDService:
             started.set()
             await sleep(AED_UPDATE_DELAY.total_seconds())
 
-    @classmethod
+    @staticmethod
+    async def publish_snapshot_task() -> NoReturn:
+        """
+        Publish the AED snapshot shared with the workers after the AEDs change, at most once per interval.
+
+        Runs apart from the database updates, so a failing publish never holds them up.
+        """
+        # publish on startup, unless the snapshot is current
+        _snapshot_outdated.set()
+
+        while True:
+            await _snapshot_outdated.wait()
+            # cleared before reading, so changes committed during the publish trigger another one
+            _snapshot_outdated.clear()
+
+            with start_transaction(op='db.snapshot', name=AEDService.publish_snapshot_task.__qualname__):
+                try:
+                    await _publish_snapshot()
+                except Exception:
+                    # workers keep using the previous snapshot until the retry
+                    logging.warning('Failed to publish AED snapshot', exc_info=True)
+                    _snapshot_outdated.set()
+
+            # changes made meanwhile are batched into one publish
+            await sleep(AED_SNAPSHOT_PUBLISH_INTERVAL.total_seconds())
+
+    @staticmethod
+    @trace
+    async def import_snapshot(
+        batches: AsyncIterable[Iterable[OSMNode]], data_timestamp: float, sequence_number: int | None
+    ) -> int:
+        """
+        Replace all AEDs with the given nodes, e.g., read from a local OSM file.
+
+        Diff updates continue from the given timestamp and minutely sequence number.
+        """
+        count = await _load_snapshot(batches)
+        await StateService.set(
+            'aed',
+            {'update_timestamp': data_timestamp, 'sequence_number': sequence_number, 'version': 3},
+        )
+        return count
+
+    @staticmethod
+    @trace
+    async def update_country_codes() -> None:
+        await _assign_country_codes()
+
+    @staticmethod
     @trace
-    async def update_country_codes(cls) -> None:
-        await _assign_country_codes(await cls.get_all())
+    async def update_country_codes_within(session: AsyncSession, regions: Table) -> int:
+        """
+        Reassign the country codes of AEDs inside any of the region geometries, within the session transaction.
+
+        Returns the number of updated AEDs.
+        """
+        aed = aliased(AED)
+        ids = select(aed.id).join(regions, func.ST_Intersects(aed.position, regions.c.geometry))
+        stmt = update(AED).where(AED.id.in_(ids)).values({AED.country_codes: _select_country_codes(AED.position)})
+        result = await session.execute(stmt)
+        return result.rowcount  # pyright: ignore[reportAttributeAccessIssue]
+
+    @staticmethod
+    def invalidate_country_counts(country_codes: Iterable[str]) -> None:
+        for country_code in country_codes:
+            _COUNTRY_BY_COUNTRY_CODE_CACHE.pop(country_code, None)
+
+        # the snapshot carries the country counts too
+        _snapshot_outdated.set()
 
     @staticmethod
     @trace
     async def count_by_country_code(country_code: str) -> int:
+        snapshot = await aed_snapshot.get()
+        if snapshot is not None:
+            return snapshot.count_by_country_code(country_code)
+
         result = _COUNTRY_BY_COUNTRY_CODE_CACHE.get(country_code)
         if result is None:
             async with db_read() as session:
@@ -69,17 +191,27 @@ class AEDService:
 
     @staticmethod
     @trace
-    async def get_all() -> Sequence[AED]:
+    async def get_all() -> tuple[Sequence[AED], int]:
+        """
+        Get all AEDs, and the change sequence they are up to date with.
+        """
         async with db_read() as session:
+            # the sequence is read first, so the data is never older than it;
+            # changes already included are harmless for clients to apply again
+            sequence = await AEDChangeService.get_latest_sequence_within(session)
             stmt = select(AED)
-            return (await session.scalars(stmt)).all()
+            return (await session.scalars(stmt)).all(), sequence
 
     @classmethod
     @trace
-    async def get_by_country_code(cls, country_code: str) -> Sequence[AED]:
+    async def get_by_country_code(cls, country_code: str) -> tuple[Sequence[AED], int]:
+        """
+        Get the AEDs in the country, and the change sequence they are up to date with.
+        """
         async with db_read() as session:
+            sequence = await AEDChangeService.get_latest_sequence_within(session)
             stmt = select(AED).where(any_(AED.country_codes) == country_code)
-            return (await session.scalars(stmt)).all()
+            return (await session.scalars(stmt)).all(), sequence
 
     @classmethod
     @trace
@@ -87,6 +219,11 @@ class AEDService:
         cls, bbox_or_geom: BBox | BaseGeometry, group_eps: float | None
     ) -> Sequence[AED | AEDGroup]:
         geometry = bbox_or_geom.to_polygon() if isinstance(bbox_or_geom, BBox) else bbox_or_geom
+
+        # grouping only needs the positions, which the shared snapshot has without a database query
+        if group_eps is not None and (snapshot := await aed_snapshot.get()) is not None:
+            return await _get_intersecting_snapshot(snapshot, geometry, group_eps)
+
         geometry_wkt = geometry.wkt
 
         async with db_read() as session:
@@ -97,31 +234,12 @@ class AEDService:
             return aeds
 
         positions = get_coordinates([aed.position for aed in aeds])
-
-        # deterministic sampling
-        max_fit_samples = 7000
-        if len(positions) > max_fit_samples:
-            indices = np.linspace(0, len(positions), max_fit_samples, endpoint=False, dtype=int)
-            fit_positions = positions[indices]
-        else:
-            fit_positions = positions
-
-        with start_span(description=f'Fitting model with {len(fit_positions)} samples'):
-            model = Birch(
-                threshold=group_eps,
-                n_clusters=None,  # type: ignore
-                compute_labels=False,
-            )
-            model.fit(fit_positions)
-            center_points = cast(Collection[Point], points(model.subcluster_centers_))
+        center_points, clusters = _fit_clusters(positions, group_eps)
 
         with start_span(description=f'Processing {len(aeds)} samples'):
             cluster_groups: tuple[list[AED], ...] = tuple([] for _ in range(len(center_points)))
             result: list[AED | AEDGroup] = []
 
-            with start_span(description='Clustering'):
-                clusters = model.predict(positions)
-
             cluster: int
             for aed, cluster in zip(aeds, clusters, strict=True):
                 cluster_groups[cluster].append(aed)
@@ -144,177 +262,379 @@ class AEDService:
         return result
 
 
+def _fit_clusters(positions: np.ndarray, group_eps: float) -> tuple[Collection[Point], np.ndarray]:
+    """
+    Group the positions, returning the cluster centers and the cluster of each position.
+    """
+    # deterministic sampling
+    max_fit_samples = 7000
+    if len(positions) > max_fit_samples:
+        indices = np.linspace(0, len(positions), max_fit_samples, endpoint=False, dtype=int)
+        fit_positions = positions[indices]
+    else:
+        fit_positions = positions
+
+    with start_span(description=f'Fitting model with {len(fit_positions)} samples'):
+        model = Birch(
+            threshold=group_eps,
+            n_clusters=None,  # type: ignore
+            compute_labels=False,
+        )
+        model.fit(fit_positions)
+        center_points = cast(Collection[Point], points(model.subcluster_centers_))
+
+    with start_span(description='Clustering'):
+        clusters = model.predict(positions)
+
+    return center_points, clusters
+
+
+async def _get_intersecting_snapshot(
+    snapshot: aed_snapshot.AEDSnapshot, geometry: BaseGeometry, group_eps: float
+) -> Sequence[AED | AEDGroup]:
+    positions = snapshot.aed_position
+    min_lon, min_lat, max_lon, max_lat = geometry.bounds
+    mask = (
+        (positions[:, 0] >= min_lon)
+        & (positions[:, 0] <= max_lon)
+        & (positions[:, 1] >= min_lat)
+        & (positions[:, 1] <= max_lat)
+    )
+    indices = np.flatnonzero(mask)
+    if not geometry.equals(box(min_lon, min_lat, max_lon, max_lat)):
+        indices = indices[intersects_xy(geometry, positions[indices, 0], positions[indices, 1])]
+
+    if len(indices) <= 1:
+        return await _get_by_ids(snapshot.aed_id[indices])
+
+    ids = snapshot.aed_id[indices]
+    positions = positions[indices]
+    center_points, clusters = _fit_clusters(positions, group_eps)
+
+    with start_span(description=f'Processing {len(ids)} samples'):
+        order = np.argsort(clusters, kind='stable')
+        counts = np.bincount(clusters, minlength=len(center_points))
+        splits = np.cumsum(counts)[:-1]
+        cluster_ids = np.split(ids[order], splits)
+        cluster_accesses = np.split(snapshot.aed_access[indices][order], splits)
+
+        # only individual AEDs need their full rows
+        single_ids = ids[counts[clusters] == 1]
+        id_aed_map = {aed.id: aed for aed in await _get_by_ids(single_ids)}
+        result: list[AED | AEDGroup] = []
+
+        for group_ids, group_accesses, center_point in zip(cluster_ids, cluster_accesses, center_points, strict=True):
+            if len(group_ids) == 0:
+                continue
+            if len(group_ids) == 1:
+                # removed since the snapshot was published
+                if (aed := id_aed_map.get(int(group_ids[0]))) is not None:
+                    result.append(aed)
+                continue
+
+            result.append(
+                AEDGroup(
+                    position=center_point,
+                    count=len(group_ids),
+                    access=AEDGroup.decide_access(snapshot.access_values[group_accesses].tolist()),
+                )
+            )
+
+    return result
+
+
+async def _get_by_ids(ids: np.ndarray) -> Sequence[AED]:
+    if not len(ids):
+        return ()
+
+    async with db_read() as session:
+        stmt = select(AED).where(AED.id.in_(ids.tolist()))
+        return (await session.scalars(stmt)).all()
+
+
 @trace
-async def _assign_country_codes(aeds: Collection[AED]) -> None:
-    if not aeds:
-        return
+async def _assign_country_codes() -> None:
+    """
+    Reassign the country codes of all AEDs.
 
-    ids: set[int] = set(map(attrgetter('id'), aeds))
+    Runs entirely in the database, in id-ordered chunks committed one at a time.
+    """
+    last_id = -1
+    total = 0
 
-    async with db_write() as session:
-        stmt = (
-            update(AED)
-            .where(AED.id.in_(text(','.join(str(id) for id in ids))))
-            .values({
-                AED.country_codes: select(array_agg(Country.code))
-                .where(func.ST_Intersects(Country.geometry, AED.position))
-                .scalar_subquery()
-            })
-        )
-        await session.execute(stmt)
+    while True:
+        async with db_write() as session:
+            batch = select(AED.id).where(AED.id > last_id).order_by(AED.id).limit(_ASSIGN_CHUNK_SIZE).cte('batch')
+            updated = (
+                update(AED)
+                .where(AED.id == batch.c.id)
+                .values({AED.country_codes: _select_country_codes(AED.position)})
+                .returning(AED.id)
+                .cte('updated')
+            )
+            stmt = select(func.max(updated.c.id), func.count()).select_from(updated)
+            max_id, count = (await session.execute(stmt)).one()
+
+        if not count:
+            break
+
+        last_id = max_id
+        total += count
+        logging.info('Updated country codes of %d AEDs', total)
+
+
+def _select_country_codes(position):
+    # a point on the edge between two parts of the same country matches both
+    return (
+        select(array_agg(CountryPart.country_code.distinct()))
+        .where(func.ST_Intersects(CountryPart.geometry, position))
+        .scalar_subquery()
+    )
 
 
 @trace
-async def _should_update_db() -> tuple[bool, float]:
+async def _should_update_db() -> tuple[bool, float, int | None]:
     doc = await StateService.get('aed')
     if doc is None or doc.get('version', 1) < 3:
-        return True, 0
+        return True, 0, None
 
     update_timestamp: float = doc['update_timestamp']
+    sequence_number: int | None = doc.get('sequence_number')
     update_age = time() - update_timestamp
     if update_age > AED_UPDATE_DELAY.total_seconds():
-        return True, update_timestamp
+        return True, update_timestamp, sequence_number
 
-    return False, update_timestamp
+    return False, update_timestamp, sequence_number
 
 
 @retry_exponential(None, start=4)
 @trace
 async def _update_db() -> None:
-    update_required, update_timestamp = await _should_update_db()
+    update_required, update_timestamp, sequence_number = await _should_update_db()
     if not update_required:
         return
 
     update_age = time() - update_timestamp
 
-    if update_age > AED_REBUILD_THRESHOLD.total_seconds():
+    # replayed diffs are old by nature, never replace them with a live snapshot
+    if update_age > AED_REBUILD_THRESHOLD.total_seconds() and PLANET_DIFF_REPLAY_DIR is None:
         await _update_db_snapshot()
     else:
-        await _update_db_diffs(update_timestamp)
+        await _update_db_diffs(update_timestamp, sequence_number)
+
+
+@trace
+async def _publish_snapshot() -> None:
+    """
+    Publish the AED snapshot shared with the workers, if AEDs or their countries changed since the last one.
+    """
+    global _published_snapshot_key
+
+    country_state = await StateService.get('country')
+    key = (
+        await AEDChangeService.get_latest_sequence(),
+        country_state.get('update_timestamp') if country_state is not None else None,
+    )
+    if key == _published_snapshot_key:
+        return
+
+    async with db_read() as session:
+        stmt = select(AED.id, func.ST_X(AED.position), func.ST_Y(AED.position), AED.tags['access'].astext)
+        rows = (await session.execute(stmt)).all()
+
+        codes = select(func.unnest(AED.country_codes).label('code')).subquery()
+        stmt = select(codes.c.code, func.count()).group_by(codes.c.code)
+        code_counts = (await session.execute(stmt)).all()
+
+    aed_id = np.fromiter((row[0] for row in rows), np.int64, len(rows))
+    aed_position = np.array([(row[1], row[2]) for row in rows], np.float64).reshape(-1, 2)
+    access_values, aed_access = np.unique(np.array([row[3] or '' for row in rows], str), return_inverse=True)
+
+    country_code = np.array([row[0] for row in code_counts], str)
+    country_count = np.fromiter((row[1] for row in code_counts), np.int64, len(code_counts))
+    order = np.argsort(country_code)
+
+    await to_thread(
+        aed_snapshot.publish,
+        aed_id,
+        aed_position,
+        aed_access.astype(np.uint32),
+        access_values,
+        country_code[order],
+        country_count[order],
+    )
+    _published_snapshot_key = key
 
 
 @trace
 async def _update_db_snapshot() -> None:
     logging.info('Updating aed database (overpass)...')
-    elements, data_timestamp = await query_overpass(_OVERPASS_QUERY, timeout=3600, must_return=True)
-    aeds = tuple(_process_overpass_node(e) for e in elements)
 
-    async with db_write() as session:
-        await session.execute(text(f'TRUNCATE "{AED.__tablename__}" CASCADE'))
-        session.add_all(aeds)
+    async with stream_overpass(_OVERPASS_QUERY, timeout=3600) as (data_timestamp, batches):
+        count = await _load_snapshot(map(_process_overpass_node, batch) async for batch in batches)
 
     await StateService.set('aed', {'update_timestamp': data_timestamp, 'version': 3})
+    logging.info('AED update finished (=%d)', count)
 
-    if aeds:
-        logging.info('Updating country codes')
-        await _assign_country_codes(aeds)
 
-        logging.info('Updating statistics')
-        async with db_write() as session:
-            await session.connection(execution_options={'isolation_level': 'AUTOCOMMIT'})
-            await session.execute(text(f'ANALYZE "{AED.__tablename__}"'))
+async def _load_snapshot(batches: AsyncIterable[Iterable[OSMNode]]) -> int:
+    """
+    Replace all AEDs with the given nodes, through a staging and a shadow table.
+
+    Returns the number of loaded nodes.
+    """
+    count = 0
+
+    async with db_write() as session:
+        await db_create_temporary_table(session, _AED_STAGING)
+
+        async for batch in batches:
+            count += await _copy_to_staging(session, batch)
+            logging.debug('Loaded %d AEDs', count)
 
-    logging.info('AED update finished (=%d)', len(aeds))
+        if not count:
+            raise ValueError('No elements returned')
+
+        shadow = await db_create_shadow_table(session, AED.__table__)
+        await session.execute(insert(shadow).from_select(_MERGE_COLUMNS, _select_staging()))
+        await db_swap_shadow_table(session, AED.__table__, shadow)
+        await AEDChangeService.reset(session)
+
+    _snapshot_outdated.set()
+    return count
 
 
 @trace
-async def _update_db_diffs(last_update: float) -> None:
+async def _update_db_diffs(last_update: float, last_sequence_number: int | None) -> None:
+    global _aed_ids_cache
+
     logging.info('Updating aed database (diff)...')
-    actions, data_timestamp = await get_planet_diffs(last_update)
+    aed_ids = await _get_aed_ids(last_update)
+    nodes, remove_ids, data_timestamp, sequence_number = await get_planet_diffs(
+        last_update, last_sequence_number, aed_ids
+    )
 
     if data_timestamp <= last_update:
         logging.info('Nothing to update')
+        _aed_ids_cache = (last_update, aed_ids)
         return
 
-    # aeds need to be deduplicated to use ON CONFLICT
-    id_aed_map: dict[int, AED] = {}
-    remove_ids: set[int] = set()
-
-    for action in actions:
-        for result in _process_action(action):
-            if isinstance(result, AED):
-                prev = id_aed_map.get(result.id)
-                if prev is None or prev.version < result.version:
-                    id_aed_map[result.id] = result
-            else:
-                remove_ids.add(result)
-
-    aeds = id_aed_map.values()
-
-    async with db_write() as session:
-        if aeds:
-            stmt = insert(AED).values([
-                {
-                    'id': aed.id,
-                    'version': aed.version,
-                    'tags': aed.tags,
-                    'position': aed.position,
-                    'country_codes': None,
-                }
-                for aed in aeds
-            ])
+    # held until commit, so a country update cannot reassign codes in between
+    async with CountryService.country_index_lock(), db_write() as session:
+        if nodes:
+            await db_create_temporary_table(session, _AED_STAGING)
+            await _copy_to_staging(session, nodes)
+            stmt = insert(AED).from_select(_MERGE_COLUMNS, _select_staging())
             stmt = stmt.on_conflict_do_update(
                 index_elements=(AED.id,),
                 set_={
                     'version': stmt.excluded.version,
                     'tags': stmt.excluded.tags,
                     'position': stmt.excluded.position,
-                    'country_codes': None,
+                    'country_codes': stmt.excluded.country_codes,
                 },
             )
             await session.execute(stmt)
 
-        if remove_ids:
-            stmt = delete(AED).where(AED.id.in_(text(','.join(str(id) for id in remove_ids))))
+            staged = _select_staging().subquery()
+            stmt = insert(AEDChange).from_select(
+                ('aed_id', 'version', 'tags', 'position'),
+                select(staged.c.id, staged.c.version, staged.c.tags, staged.c.position),
+            )
+            await session.execute(stmt)
+
+        if len(remove_ids):
+            await db_create_temporary_table(session, _AED_REMOVE_STAGING)
+            await _copy_remove_staging(session, remove_ids)
+            deleted = delete(AED).where(AED.id == _AED_REMOVE_STAGING.c.id).returning(AED.id).cte('deleted')
+            stmt = insert(AEDChange).from_select(('aed_id',), select(deleted.c.id)).add_cte(deleted)
             await session.execute(stmt)
 
-    await StateService.set('aed', {'update_timestamp': data_timestamp, 'version': 3})
+    await StateService.set(
+        'aed',
+        {'update_timestamp': data_timestamp, 'sequence_number': sequence_number, 'version': 3},
+    )
 
-    if aeds:
-        logging.info('Updating country codes')
-        await _assign_country_codes(aeds)
+    # get_planet_diffs added the upserted AEDs
+    aed_ids.difference_update(remove_ids.tolist())
+    _aed_ids_cache = (data_timestamp, aed_ids)
 
-    logging.info('AED update finished (+%d, -%d)', len(aeds), len(remove_ids))
+    if nodes or len(remove_ids):
+        _snapshot_outdated.set()
 
+    await AEDChangeService.prune()
+    logging.info('AED update finished (+%d, -%d)', len(nodes), len(remove_ids))
 
-def _process_action(action: dict) -> Iterable[AED | int]:
-    if action['@type'] in ('create', 'modify'):
-        return (_process_action_create_or_modify(node) for node in action['node'])
-    elif action['@type'] == 'delete':
-        return map(itemgetter('@id'), action['node'])
-    else:
-        raise NotImplementedError(f'Unknown action type: {action["@type"]}')
-
-
-def _process_action_create_or_modify(node: dict) -> AED | int:
-    tags = _parse_xml_tags(node)
-    if _is_defibrillator(tags):
-        return AED(
-            id=node['@id'],
-            version=node['@version'],
-            tags=tags,
-            position=Point(node['@lon'], node['@lat']),
-            country_codes=None,
-        )
-    else:
-        return node['@id']
 
+async def _get_aed_ids(last_update: float) -> set[int]:
+    """
+    Get the ids of the stored AEDs, as of the given update.
+
+    The set is kept between diff updates, and reloaded after anything else replaced the data.
+    """
+    global _aed_ids_cache
+
+    # the caller modifies the set, it is only stored again once the update succeeds
+    cached, _aed_ids_cache = _aed_ids_cache, None
+    if cached is not None and cached[0] == last_update:
+        return cached[1]
 
-def _parse_xml_tags(data: dict) -> dict[str, str]:
-    tags = data.get('tag', [])
-    return {tag['@k']: tag['@v'] for tag in tags}
+    async with db_read() as session:
+        return set((await session.scalars(select(AED.id))).all())
+
+
+@trace
+async def _copy_to_staging(session: AsyncSession, nodes: Iterable[OSMNode]) -> int:
+    nodes = tuple(nodes)
+    coords = np.array([(node.lon, node.lat) for node in nodes], np.float64).reshape(-1, 2)
+    country_codes = await CountryService.get_country_codes(coords)
+    await db_copy_records(
+        session,
+        _AED_STAGING.name,
+        _AED_STAGING.columns.keys(),
+        (
+            (node.id, node.version, json.dumps(node.tags), node.lon, node.lat, codes)
+            for node, codes in zip(nodes, country_codes, strict=True)
+        ),
+    )
+    return len(nodes)
+
+
+@trace
+async def _copy_remove_staging(session: AsyncSession, ids: np.ndarray) -> None:
+    await db_copy_records(
+        session,
+        _AED_REMOVE_STAGING.name,
+        _AED_REMOVE_STAGING.columns.keys(),
+        ((id,) for id in ids.tolist()),
+    )
+
+
+def _select_staging():
+    """
+    Select the staged nodes as AED rows.
+
+    Country codes are computed in-process while staging, see CountryService.get_country_codes.
+    """
+    return select(
+        _AED_STAGING.c.id,
+        _AED_STAGING.c.version,
+        _AED_STAGING.c.tags,
+        func.ST_SetSRID(func.ST_MakePoint(_AED_STAGING.c.lon, _AED_STAGING.c.lat), 4326).label('position'),
+        _AED_STAGING.c.country_codes,
+    )
 
 
-def _process_overpass_node(node: dict) -> AED:
+def _process_overpass_node(node: dict) -> OSMNode:
     tags = node.get('tags', {})
     if not _is_defibrillator(tags):
         raise AssertionError('Unexpected non-defibrillator node')
-    return AED(
+    return OSMNode(
         id=node['id'],
         version=node['version'],
         tags=tags,
-        position=Point(node['lon'], node['lat']),
-        country_codes=None,
+        lon=node['lon'],
+        lat=node['lat'],
     )
 
 
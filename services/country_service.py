@@ -1,23 +1,52 @@
+import json
 import logging
-from asyncio import Event, sleep
-from collections.abc import Sequence
+from asyncio import Event, Lock, sleep
+from collections.abc import Collection, Iterable, Sequence
+from hashlib import blake2b
+from math import asinh, pi, radians, tan
 from time import time
 from typing import NoReturn
 
+import numpy as np
 from sentry_sdk import start_transaction, trace
+from shapely import STRtree, points, to_wkb
 from shapely.geometry import Point
-from sqlalchemy import func, select, text
+from shapely.geometry.base import BaseGeometry
+from sqlalchemy import Column, MetaData, Table, Unicode, delete, func, select, text
+from sqlalchemy.dialects.postgresql import insert
 
-from config import COUNTRY_UPDATE_DELAY
+from config import COUNTRY_SUBDIVIDE_MAX_VERTICES, COUNTRY_UPDATE_DELAY, TILE_COUNTRIES_MAX_Z
 from country_code_assigner import CountryCodeAssigner
-from db import db_read, db_write
+from db import db_create_shadow_table, db_create_temporary_table, db_read, db_swap_shadow_table, db_write
+from middlewares.cache_response_middleware import invalidate_cached_responses
 from models.bbox import BBox
 from models.db.aed import AED
 from models.db.country import Country
+from models.db.country_part import CountryPart
+from models.geometry import GeometryType
 from osm_countries import get_osm_countries
 from services.state_service import StateService
 from utils import retry_exponential
 
+_COUNTRY_INDEX: _CountryIndex | None = None
+_COUNTRY_INDEX_LOCK = Lock()
+
+_COUNTRY_OLD = Table(
+    'country_old',
+    MetaData(),
+    Column('code', Unicode(8), nullable=False),
+    Column('geometry', GeometryType, nullable=False),
+    prefixes=('TEMPORARY',),
+    postgresql_on_commit='DROP',
+)
+_COUNTRY_REGION = Table(
+    'country_region',
+    MetaData(),
+    Column('geometry', GeometryType, nullable=False),
+    prefixes=('TEMPORARY',),
+    postgresql_on_commit='DROP',
+)
+
 
 class CountryService:
     @staticmethod
@@ -45,28 +74,98 @@ class CountryService:
         geometry_wkt = geometry.wkt
 
         async with db_read() as session:
-            stmt = select(Country).where(func.ST_Intersects(Country.geometry, func.ST_GeomFromText(geometry_wkt, 4326)))
+            stmt = select(Country).where(
+                Country.code.in_(
+                    select(CountryPart.country_code).where(
+                        func.ST_Intersects(CountryPart.geometry, func.ST_GeomFromText(geometry_wkt, 4326))
+                    )
+                )
+            )
             return (await session.scalars(stmt)).all()
 
+    @staticmethod
+    @trace
+    async def get_country_codes(coords: np.ndarray) -> list[list[str] | None]:
+        """
+        Get the codes of the countries containing each of the given (lon, lat) coordinates.
+
+        Uses an in-memory index of the subdivided country geometries, loaded on first use
+        and reloaded as soon as the stored country parts change.
+        Callers storing the result must hold country_index_lock until they commit.
+        """
+        global _COUNTRY_INDEX
+        if _COUNTRY_INDEX is None:
+            _COUNTRY_INDEX = await _load_country_index()
+        return _COUNTRY_INDEX.query(coords)
+
+    @staticmethod
+    def country_index_lock() -> Lock:
+        """
+        Lock held while the country parts and the in-memory index are replaced.
+
+        Holding it until commit keeps country codes computed from a stale index
+        from overwriting the reassigned ones.
+        """
+        return _COUNTRY_INDEX_LOCK
+
+
+class _CountryIndex:
+    __slots__ = ('_codes', '_part_codes', '_tree')
+
+    def __init__(self, parts: Sequence[tuple[str, BaseGeometry]]) -> None:
+        self._codes = tuple(sorted({code for code, _ in parts}))
+        code_index = {code: i for i, code in enumerate(self._codes)}
+        self._part_codes = np.fromiter((code_index[code] for code, _ in parts), np.int64, len(parts))
+        self._tree = STRtree([geometry for _, geometry in parts])
+
+    def query(self, coords: np.ndarray) -> list[list[str] | None]:
+        result: list[list[str] | None] = [None] * len(coords)
+        if not len(coords):
+            return result
+
+        point_indices, part_indices = self._tree.query(points(coords), predicate='intersects')
+
+        # a point on the edge between two parts of the same country matches both
+        pairs = np.unique(np.column_stack((point_indices, self._part_codes[part_indices])), axis=0)
+
+        for point_index, code_index in pairs.tolist():
+            codes = result[point_index]
+            if codes is None:
+                result[point_index] = codes = []
+            codes.append(self._codes[code_index])
+
+        return result
+
+
+@trace
+async def _load_country_index() -> _CountryIndex:
+    async with db_read() as session:
+        stmt = select(CountryPart.country_code, CountryPart.geometry)
+        parts = (await session.execute(stmt)).tuples().all()
+
+    logging.debug('Loaded %d country parts into the index', len(parts))
+    return _CountryIndex(parts)
+
 
 @trace
-async def _should_update_db() -> tuple[bool, float]:
+async def _should_update_db() -> tuple[bool, float, dict[str, list[str]] | None]:
     data = await StateService.get('country')
     if data is None or data.get('version', 1) < 2:
-        return True, 0
+        return True, 0, None
 
     update_timestamp: float = data['update_timestamp']
+    hashes: dict[str, list[str]] | None = data.get('hashes')
     update_age = time() - update_timestamp
     if update_age > COUNTRY_UPDATE_DELAY.total_seconds():
-        return True, update_timestamp
+        return True, update_timestamp, hashes
 
-    return False, update_timestamp
+    return False, update_timestamp, hashes
 
 
 @retry_exponential(None, start=4)
 @trace
 async def _update_db() -> None:
-    update_required, update_timestamp = await _should_update_db()
+    update_required, update_timestamp, stored_hashes = await _should_update_db()
     if not update_required:
         return
 
@@ -84,33 +183,209 @@ async def _update_db() -> None:
         return
 
     code_assigner = CountryCodeAssigner()
-    countries = tuple(
-        Country(
-            code=code_assigner.get_unique(c.tags),
-            names=_get_names(c.tags),
-            geometry=c.geometry,
-            label_position=c.representative_point,
-        )
+    countries = [
+        {
+            'code': code_assigner.get_unique(c.tags),
+            'names': _get_names(c.tags),
+            'geometry': c.geometry,
+            'label_position': c.representative_point,
+        }
         for c in osm_countries
-    )
+    ]
+    hashes = {country['code']: _hash_country(country) for country in countries}
 
-    async with db_write() as session:
-        await session.execute(text(f'TRUNCATE "{Country.__tablename__}" CASCADE'))
-        session.add_all(countries)
+    if stored_hashes is None:
+        await _update_db_full(countries)
+    else:
+        await _update_db_changed(countries, hashes, stored_hashes)
 
-    await StateService.set('country', {'update_timestamp': data_timestamp, 'version': 2})
+    await StateService.set('country', {'update_timestamp': data_timestamp, 'version': 3, 'hashes': hashes})
+    logging.info('Country update finished')
+
+
+@trace
+async def _update_db_full(countries: Sequence[dict]) -> None:
+    global _COUNTRY_INDEX
+
+    async with _COUNTRY_INDEX_LOCK:
+        async with db_write() as session:
+            shadow = await db_create_shadow_table(session, Country.__table__)
+            await session.execute(insert(shadow), countries)
+            part_shadow = await db_create_shadow_table(session, CountryPart.__table__)
+            await session.execute(
+                insert(part_shadow).from_select(('country_code', 'part', 'geometry'), _select_country_parts(shadow))
+            )
+            await db_swap_shadow_table(session, Country.__table__, shadow)
+            await db_swap_shadow_table(session, CountryPart.__table__, part_shadow)
+
+        # diff updates must stage with the new parts before the reassignment reaches their AEDs
+        _COUNTRY_INDEX = await _load_country_index()
 
     logging.info('Updating country codes')
     from services.aed_service import AEDService
 
     await AEDService.update_country_codes()
+    AEDService.invalidate_country_counts(country['code'] for country in countries)
 
     logging.info('Updating statistics')
     async with db_write() as session:
         await session.connection(execution_options={'isolation_level': 'AUTOCOMMIT'})
-        await session.execute(text(f'ANALYZE "{AED.__tablename__}", "{Country.__tablename__}"'))
+        await session.execute(text(f'ANALYZE "{AED.__tablename__}"'))
 
-    logging.info('Country update finished')
+
+@trace
+async def _update_db_changed(
+    countries: Sequence[dict],
+    hashes: dict[str, list[str]],
+    stored_hashes: dict[str, list[str]],
+) -> None:
+    """
+    Update only the countries that differ from the stored ones.
+
+    Country codes are reassigned only for AEDs inside the symmetric difference
+    of the old and new geometries, the only area where they can change.
+    """
+    changed = [country for country in countries if hashes[country['code']] != stored_hashes.get(country['code'])]
+    removed_codes = stored_hashes.keys() - hashes.keys()
+
+    # the first hash covers the geometry, the second the names and label position
+    geometry_codes = {
+        country['code']
+        for country in changed
+        if (stored_hash := stored_hashes.get(country['code'])) is None or stored_hash[0] != hashes[country['code']][0]
+    }
+    geometry_codes.update(removed_codes)
+
+    if not changed and not removed_codes:
+        logging.info('No countries changed')
+        return
+
+    logging.info('Updating %d changed and %d removed countries', len(changed), len(removed_codes))
+    from services.aed_service import AEDService
+
+    global _COUNTRY_INDEX
+
+    async with _COUNTRY_INDEX_LOCK:
+        async with db_write() as session:
+            await db_create_temporary_table(session, _COUNTRY_OLD)
+            await session.execute(
+                insert(_COUNTRY_OLD).from_select(
+                    ('code', 'geometry'),
+                    select(Country.code, Country.geometry).where(Country.code.in_(geometry_codes)),
+                )
+            )
+            bounds_stmt = select(
+                func.ST_XMin(_COUNTRY_OLD.c.geometry),
+                func.ST_YMin(_COUNTRY_OLD.c.geometry),
+                func.ST_XMax(_COUNTRY_OLD.c.geometry),
+                func.ST_YMax(_COUNTRY_OLD.c.geometry),
+            )
+            bounds = [*(await session.execute(bounds_stmt)).tuples().all()]
+            bounds.extend(country['geometry'].bounds for country in changed)
+
+            if changed:
+                stmt = insert(Country)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=(Country.code,),
+                    set_={
+                        'names': stmt.excluded.names,
+                        'geometry': stmt.excluded.geometry,
+                        'label_position': stmt.excluded.label_position,
+                    },
+                )
+                await session.execute(stmt, changed)
+
+            if removed_codes:
+                await session.execute(delete(Country).where(Country.code.in_(removed_codes)))
+
+            updated = 0
+            if geometry_codes:
+                await session.execute(delete(CountryPart).where(CountryPart.country_code.in_(geometry_codes)))
+                country = Country.__table__
+                await session.execute(
+                    insert(CountryPart).from_select(
+                        ('country_code', 'part', 'geometry'),
+                        _select_country_parts(country).where(country.c.code.in_(geometry_codes)),
+                    )
+                )
+
+                await db_create_temporary_table(session, _COUNTRY_REGION)
+                await session.execute(
+                    insert(_COUNTRY_REGION).from_select(('geometry',), _select_changed_regions(geometry_codes))
+                )
+                updated = await AEDService.update_country_codes_within(session, _COUNTRY_REGION)
+
+        # reloaded before releasing the lock, diff updates would otherwise stage stale codes
+        if geometry_codes:
+            _COUNTRY_INDEX = await _load_country_index()
+
+    logging.info('Updated country codes of %d AEDs', updated)
+    AEDService.invalidate_country_counts(geometry_codes)
+    await invalidate_cached_responses({
+        '/api/v1/countries/names',
+        *(f'/api/v1/countries/{code}.geojson' for code in geometry_codes),
+        *_get_country_tile_paths(bounds),
+    })
+
+
+def _hash_country(country: dict) -> list[str]:
+    geometry_hash = blake2b(to_wkb(country['geometry']), digest_size=16).hexdigest()
+    properties = json.dumps(country['names'], sort_keys=True).encode() + to_wkb(country['label_position'])
+    properties_hash = blake2b(properties, digest_size=16).hexdigest()
+    return [geometry_hash, properties_hash]
+
+
+def _select_changed_regions(codes: Collection[str]):
+    """
+    Select the subdivided symmetric differences between the old and the new country geometries.
+    """
+    country = Country.__table__
+    new = select(country.c.code, country.c.geometry).where(country.c.code.in_(codes)).subquery()
+    empty = func.ST_GeomFromText('GEOMETRYCOLLECTION EMPTY', 4326)
+    difference = func.ST_SymDifference(
+        func.coalesce(_COUNTRY_OLD.c.geometry, empty),
+        func.coalesce(new.c.geometry, empty),
+    )
+    return select(func.ST_Subdivide(difference, COUNTRY_SUBDIVIDE_MAX_VERTICES)).select_from(
+        _COUNTRY_OLD.join(new, _COUNTRY_OLD.c.code == new.c.code, full=True)
+    )
+
+
+def _get_country_tile_paths(bounds: Iterable[tuple[float, float, float, float]]) -> set[str]:
+    """
+    Get the paths of the country tiles covering the given bounds.
+    """
+    result: set[str] = set()
+
+    for min_lon, min_lat, max_lon, max_lat in bounds:
+        for z in range(TILE_COUNTRIES_MAX_Z + 1):
+            min_x, min_y = _point_to_tile(z, min_lon, max_lat)
+            max_x, max_y = _point_to_tile(z, max_lon, min_lat)
+            result.update(
+                f'/api/v1/tile/{z}/{x}/{y}.mvt'
+                for x in range(min_x, max_x + 1)  #
+                for y in range(min_y, max_y + 1)
+            )
+
+    return result
+
+
+def _point_to_tile(z: int, lon: float, lat: float) -> tuple[int, int]:
+    n = 2**z
+    lat_rad = radians(min(max(lat, -85.0511), 85.0511))
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - asinh(tan(lat_rad)) / pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def _select_country_parts(country: Table):
+    """
+    Split country geometries into pieces of bounded size, so that point-in-polygon tests
+    only walk a few hundred vertices after the index lookup.
+    """
+    subdivide = func.ST_Subdivide(country.c.geometry, COUNTRY_SUBDIVIDE_MAX_VERTICES)
+    parts = subdivide.table_valued('geometry', with_ordinality='part').render_derived()
+    return select(country.c.code, parts.c.part, parts.c.geometry).select_from(country, parts)
 
 
 def _get_names(tags: dict[str, str]) -> dict[str, str]:
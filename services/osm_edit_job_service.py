@@ -0,0 +1,176 @@
+import logging
+from asyncio import sleep
+from typing import NoReturn
+
+from httpx import HTTPStatusError
+from pydantic import SecretStr
+from sentry_sdk import start_transaction, trace
+from sqlalchemy import delete, func, select, update
+from starlette import status
+
+from config import (
+    OSM_EDIT_JOB_MAX_ATTEMPTS,
+    OSM_EDIT_JOB_POLL_INTERVAL,
+    OSM_EDIT_JOB_RETENTION,
+    OSM_EDIT_JOB_RETRY_DELAY,
+)
+from db import db_read, db_write
+from models.db.osm_edit_job import OSMEditJob
+from openstreetmap import OpenStreetMap
+from osm_change import update_node_tags_osm_change
+from services.photo_service import PhotoService
+from utils import retry_exponential
+
+
+class OSMEditJobService:
+    @staticmethod
+    @trace
+    async def create(
+        node_id: int,
+        tags: dict[str, str],
+        access_token: SecretStr,
+        *,
+        photo_id: str | None = None,
+    ) -> OSMEditJob:
+        """
+        Queue an update of the node tags, made on behalf of the access token owner.
+
+        The given photo is deleted if the node turns out not to exist on OpenStreetMap.
+        """
+        async with db_write() as session:
+            job = OSMEditJob(
+                node_id=node_id,
+                tags=tags,
+                access_token=access_token.get_secret_value(),
+                photo_id=photo_id,
+            )
+            session.add(job)
+
+        return job
+
+    @staticmethod
+    @trace
+    async def get_by_id(id: str) -> OSMEditJob | None:
+        async with db_read() as session:
+            return await session.get(OSMEditJob, id)
+
+    @staticmethod
+    async def process_task() -> NoReturn:
+        while True:
+            with start_transaction(op='osm.edit', name=OSMEditJobService.process_task.__qualname__):
+                await _process_jobs()
+            await sleep(OSM_EDIT_JOB_POLL_INTERVAL.total_seconds())
+
+
+@retry_exponential(None, start=4)
+@trace
+async def _process_jobs() -> None:
+    while (job := await _get_next_job()) is not None:
+        await _process_job(job)
+
+    async with db_write() as session:
+        stmt = delete(OSMEditJob).where(
+            OSMEditJob.status != 'pending',
+            OSMEditJob.created_at < func.statement_timestamp() - OSM_EDIT_JOB_RETENTION,
+        )
+        await session.execute(stmt)
+
+
+async def _get_next_job() -> OSMEditJob | None:
+    async with db_read() as session:
+        stmt = (
+            select(OSMEditJob)
+            .where(
+                OSMEditJob.status == 'pending',
+                OSMEditJob.next_attempt_at <= func.statement_timestamp(),
+            )
+            .order_by(OSMEditJob.next_attempt_at)
+            .limit(1)
+        )
+        return await session.scalar(stmt)
+
+
+@trace
+async def _process_job(job: OSMEditJob) -> None:
+    osm = OpenStreetMap(SecretStr(job.access_token))  # pyright: ignore[reportArgumentType]
+
+    try:
+        if job.uploaded:
+            # only closing the changeset failed before
+            await osm.close_changeset(job.changeset_id)  # pyright: ignore[reportArgumentType]
+        else:
+            if job.changeset_id is not None:
+                # left open by an interrupted attempt
+                await osm.close_changeset(job.changeset_id)
+
+            node_xml = await osm.get_node_xml(job.node_id)
+            if node_xml is None:
+                if job.photo_id is not None:
+                    # nothing will ever link to the photo
+                    await PhotoService.delete(job.photo_id)
+                await _finish_job(job, error=f'Node {job.node_id} not found on remote')
+                return
+
+            tags = {tag['@k']: tag['@v'] for tag in node_xml.get('tag', ())}
+            if all(tags.get(k) == v for k, v in job.tags.items()):
+                # an earlier upload went through, but its response was lost
+                await _finish_job(job, changeset_id=node_xml['@changeset'])
+                return
+
+            # the node is fetched on every attempt, so version conflicts resolve themselves on retry
+            osm_change = update_node_tags_osm_change(node_xml, job.tags)
+            job.changeset_id = await osm.create_changeset()
+            await _update_job(job, {OSMEditJob.changeset_id: job.changeset_id})
+
+            try:
+                await osm.upload_osm_change(job.changeset_id, osm_change)
+                job.uploaded = True
+                await _update_job(job, {OSMEditJob.uploaded: True})
+            finally:
+                # a failed upload must not leave an empty changeset open
+                await osm.close_changeset(job.changeset_id)
+    except Exception as e:
+        attempts = job.attempts + 1
+        logging.warning('OSM edit job %r failed (attempt %d)', job.id, attempts, exc_info=True)
+
+        # the token will not become valid again
+        unauthorized = isinstance(e, HTTPStatusError) and e.response.status_code in (
+            status.HTTP_401_UNAUTHORIZED,
+            status.HTTP_403_FORBIDDEN,
+        )
+        if unauthorized or attempts >= OSM_EDIT_JOB_MAX_ATTEMPTS:
+            await _finish_job(job, error=str(e))
+            return
+
+        await _update_job(
+            job,
+            {
+                OSMEditJob.attempts: attempts,
+                OSMEditJob.next_attempt_at: func.statement_timestamp() + OSM_EDIT_JOB_RETRY_DELAY * 2 ** (attempts - 1),
+                OSMEditJob.error: str(e),
+            },
+        )
+        return
+
+    await _finish_job(job, changeset_id=job.changeset_id)
+
+
+async def _update_job(job: OSMEditJob, values: dict) -> None:
+    async with db_write() as session:
+        stmt = update(OSMEditJob).where(OSMEditJob.id == job.id).values(values)
+        await session.execute(stmt)
+
+
+async def _finish_job(job: OSMEditJob, *, changeset_id: int | None = None, error: str | None = None) -> None:
+    async with db_write() as session:
+        stmt = (
+            update(OSMEditJob)
+            .where(OSMEditJob.id == job.id)
+            .values({
+                OSMEditJob.status: 'done' if error is None else 'failed',
+                OSMEditJob.access_token: None,
+                OSMEditJob.changeset_id: changeset_id,
+                OSMEditJob.error: error,
+            })
+        )
+        await session.execute(stmt)
@@ -0,0 +1,225 @@
+import logging
+import os
+import time
+from asyncio import to_thread
+from collections.abc import AsyncIterator
+from hashlib import blake2b
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import IO
+
+import magic
+from fastapi import HTTPException
+from httpx import Response
+from sentry_sdk import trace
+
+from config import (
+    IMAGE_CONTENT_TYPES,
+    IMAGE_REMOTE_MAX_FILE_SIZE,
+    PHOTO_PROXY_CACHE_DIR,
+    PHOTO_PROXY_CACHE_EXPIRE,
+    PHOTO_PROXY_CACHE_MAX_SIZE,
+    PHOTO_PROXY_CACHE_PRUNE_INTERVAL,
+    PHOTO_PROXY_TRANSCODE,
+)
+from db import valkey
+from services.photo_service import PhotoService
+from utils import HTTP, prune_cache, write_atomic
+
+_last_prune = 0.0
+
+
+class PhotoProxyService:
+    @staticmethod
+    @trace
+    async def get_cached(source: str) -> tuple[Path, str] | None:
+        """
+        Get the locally cached copy of the remote image and its content type.
+
+        Files are stored on disk by source hash, Valkey only holds a pointer with the content type,
+        so large images do not compete with the response cache for memory.
+        """
+        key = _get_key(source)
+
+        async with valkey() as conn:
+            content_type: bytes | None = await conn.get(f'photo-proxy:{key}')
+
+        if content_type is None:
+            return None
+
+        path = _get_path(key)
+        if not await to_thread(_touch, path):
+            return None
+
+        return path, content_type.decode()
+
+    @staticmethod
+    @trace
+    async def open(source: str, url: str) -> PhotoProxyStream:
+        """
+        Start downloading the remote image, to be cached under the given source.
+
+        The type and declared size are checked before anything is sent to the client,
+        the type is sniffed from the first bytes.
+        """
+        r = await HTTP.send(HTTP.build_request('GET', url), stream=True)
+
+        try:
+            _check_response(r)
+
+            chunks = r.aiter_bytes()
+            head = b''
+            async for chunk in chunks:
+                head += chunk
+                if len(head) >= 2048:
+                    break
+
+            content_type = magic.from_buffer(head[:2048], mime=True)
+            _check_content_type(content_type)
+        except BaseException:
+            await r.aclose()
+            raise
+
+        return PhotoProxyStream(source, r, chunks, head, content_type)
+
+
+class PhotoProxyStream:
+    """
+    Remote image forwarded to the client as it downloads, while being teed into a temporary file.
+
+    Once the download is complete, save() moves the file into the cache.
+    """
+
+    __slots__ = ('_chunks', '_complete', '_head', '_response', '_source', '_temp_path', 'content_type')
+
+    def __init__(
+        self,
+        source: str,
+        response: Response,
+        chunks: AsyncIterator[bytes],
+        head: bytes,
+        content_type: str,
+    ) -> None:
+        self._source = source
+        self._response = response
+        self._chunks = chunks
+        self._head = head
+        self._temp_path: Path | None = None
+        self._complete = False
+        self.content_type = content_type
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        try:
+            with await to_thread(_create_temp_file) as f:
+                self._temp_path = Path(f.name)
+                size = len(self._head)
+                await to_thread(f.write, self._head)
+                yield self._head
+
+                async for chunk in self._chunks:
+                    # the response has already started, exceeding the limit aborts it
+                    size += len(chunk)
+                    if size > IMAGE_REMOTE_MAX_FILE_SIZE:
+                        raise ValueError(f'File is too large, max allowed size is {IMAGE_REMOTE_MAX_FILE_SIZE} bytes')
+                    await to_thread(f.write, chunk)
+                    yield chunk
+
+            self._complete = True
+        finally:
+            await self._response.aclose()
+            if not self._complete and self._temp_path is not None:
+                await to_thread(self._temp_path.unlink, missing_ok=True)
+
+    @trace
+    async def save(self) -> None:
+        """
+        Move the downloaded image into the cache, transcoding it when enabled.
+        """
+        temp_path = self._temp_path
+        if not self._complete or temp_path is None:
+            return
+
+        key = _get_key(self._source)
+        path = _get_path(key)
+        content_type = self.content_type
+
+        try:
+            if PHOTO_PROXY_TRANSCODE:
+                file = await to_thread(temp_path.read_bytes)
+                try:
+                    transcoded = await PhotoService.transcode(file)
+                except Exception:
+                    # cache the original rather than nothing
+                    logging.warning('Failed to transcode proxied image %r', self._source, exc_info=True)
+                else:
+                    # busy transcoding others, or small originals may already be compact enough
+                    if transcoded is not None and len(transcoded) < len(file):
+                        await to_thread(write_atomic, path, transcoded)
+                        content_type = 'image/webp'
+
+            if content_type == self.content_type:
+                await to_thread(_move, temp_path, path)
+        finally:
+            await to_thread(temp_path.unlink, missing_ok=True)
+
+        async with valkey() as conn:
+            await conn.set(f'photo-proxy:{key}', content_type, ex=PHOTO_PROXY_CACHE_EXPIRE)
+
+        await _maybe_prune_cache()
+
+
+def _check_response(r: Response) -> None:
+    r.raise_for_status()
+
+    # Early detection of unsupported types
+    content_type = r.headers.get('Content-Type')
+    if content_type:
+        _check_content_type(content_type)
+
+    content_length = r.headers.get('Content-Length')
+    if content_length and int(content_length) > IMAGE_REMOTE_MAX_FILE_SIZE:
+        raise HTTPException(500, f'File is too large, max allowed size is {IMAGE_REMOTE_MAX_FILE_SIZE} bytes')
+
+
+def _check_content_type(content_type: str) -> None:
+    if content_type not in IMAGE_CONTENT_TYPES:
+        raise HTTPException(500, f'Unsupported file type {content_type!r}, must be one of {IMAGE_CONTENT_TYPES}')
+
+
+def _get_key(source: str) -> str:
+    return blake2b(source.encode(), digest_size=16).hexdigest()
+
+
+def _get_path(key: str) -> Path:
+    return PHOTO_PROXY_CACHE_DIR / key[:2] / key
+
+
+def _create_temp_file() -> IO[bytes]:
+    PHOTO_PROXY_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    return NamedTemporaryFile(dir=PHOTO_PROXY_CACHE_DIR, prefix='.download.', delete=False)
+
+
+def _move(src: Path, dst: Path) -> None:
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    src.replace(dst)
+
+
+def _touch(path: Path) -> bool:
+    try:
+        os.utime(path)  # mark as recently used
+    except FileNotFoundError:
+        return False
+    return True
+
+
+async def _maybe_prune_cache() -> None:
+    global _last_prune
+
+    # listing the cache directory is not free, so it is done at most once per interval
+    now = time.monotonic()
+    if now - _last_prune < PHOTO_PROXY_CACHE_PRUNE_INTERVAL.total_seconds():
+        return
+    _last_prune = now
+
+    if removed := await to_thread(prune_cache, PHOTO_PROXY_CACHE_DIR, PHOTO_PROXY_CACHE_MAX_SIZE):
+        logging.debug('Pruned %d photo proxy cache files', removed)
@@ -13,8 +13,7 @@ class PhotoReportService:
     @staticmethod
     @trace
     async def create(photo_id: str) -> bool:
-        photo = await PhotoService.get_by_id(photo_id)
-        if photo is None:
+        if (await PhotoService.get_file_path(photo_id)) is None:
             return False  # photo not found
 
         async with db_write() as session:
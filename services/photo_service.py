@@ -1,13 +1,95 @@
 import logging
+from asyncio import Semaphore, gather, get_running_loop, sleep, timeout
+from collections.abc import AsyncIterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from io import BytesIO
+from math import ceil
+from pathlib import Path
+from typing import BinaryIO, NoReturn
 
-from fastapi import UploadFile
+from cachetools import TTLCache
+from fastapi import HTTPException, UploadFile
 from PIL import Image, ImageOps
-from sentry_sdk import add_attachment, trace
+from sentry_sdk import add_attachment, start_transaction, trace
+from sqlalchemy import delete, select
 
-from config import IMAGE_LIMIT_PIXELS, IMAGE_MAX_FILE_SIZE
-from db import db_read, db_write
+import photo_storage
+from config import (
+    IMAGE_LIMIT_PIXELS,
+    IMAGE_MAX_FILE_SIZE,
+    IMAGE_PROCESSING_CONCURRENCY,
+    IMAGE_PROCESSING_QUEUE_SIZE,
+    IMAGE_PROCESSING_QUEUE_TIMEOUT,
+    IMAGE_PROCESSING_WORKERS,
+    IMAGE_PROXY_LIMIT_PIXELS,
+    IMAGE_PROXY_MAX_FILE_SIZE,
+    IMAGE_THUMBNAIL_CONCURRENCY,
+    IMAGE_THUMBNAIL_QUALITY,
+    IMAGE_THUMBNAIL_QUEUE_SIZE,
+    IMAGE_TRANSCODE_CONCURRENCY,
+    PHOTO_INDEX_MEMORY_EXPIRE,
+    PHOTO_INDEX_MEMORY_SIZE,
+    PHOTO_INDEX_REBUILD_INTERVAL,
+    PHOTOS_DIR,
+)
+from db import db_read, db_write, valkey
 from models.db.photo import Photo
+from models.db.photo_report import PhotoReport
+
+# Pillow releases the GIL while decoding, resizing and encoding, so threads are enough
+# to keep image processing off the event loop
+_PROCESSING_EXECUTOR = ThreadPoolExecutor(IMAGE_PROCESSING_WORKERS, thread_name_prefix='photo-processing')
+
+# proxied images only use spare capacity, uploads never wait for them
+_TRANSCODE_SLOTS = Semaphore(IMAGE_TRANSCODE_CONCURRENCY)
+
+_QUALITIES = tuple(range(95, 15, -5))  # descending
+_PROXY_MAX_PIXELS = 500_000
+
+# photo id -> file path, the most recently used entries of the Valkey index
+_PHOTO_INDEX: TTLCache[str, Path] = TTLCache(PHOTO_INDEX_MEMORY_SIZE, PHOTO_INDEX_MEMORY_EXPIRE.total_seconds())
+_PHOTO_INDEX_KEY = 'photo-index'
+
+
+class _ProcessingQueue:
+    """
+    Bounded admission to image processing.
+
+    A limited number of images are processed at once and a limited number wait for their turn,
+    the rest are rejected, as are the images waiting for too long.
+    """
+
+    __slots__ = ('_size', '_slots', '_waiting')
+
+    def __init__(self, concurrency: int, size: int) -> None:
+        self._slots = Semaphore(concurrency)
+        self._size = size
+        self._waiting = 0
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        if self._slots.locked() and self._waiting >= self._size:
+            raise HTTPException(503, 'Too many images are being processed, please try again later')
+
+        self._waiting += 1
+        try:
+            async with timeout(IMAGE_PROCESSING_QUEUE_TIMEOUT.total_seconds()):
+                await self._slots.acquire()
+        except TimeoutError:
+            raise HTTPException(503, 'Too many images are being processed, please try again later') from None
+        finally:
+            self._waiting -= 1
+
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+
+# uploads and thumbnails are admitted separately, so bursts of one never reject the other
+_UPLOAD_QUEUE = _ProcessingQueue(IMAGE_PROCESSING_CONCURRENCY, IMAGE_PROCESSING_QUEUE_SIZE)
+_THUMBNAIL_QUEUE = _ProcessingQueue(IMAGE_THUMBNAIL_CONCURRENCY, IMAGE_THUMBNAIL_QUEUE_SIZE)
 
 
 class PhotoService:
@@ -19,29 +101,136 @@ class PhotoService:
 
         if photo is None:
             return None
-        if check_file and (not photo.file_path.is_file()):
+        if check_file and (not await photo_storage.is_file(photo.file_path)):
             return None
 
         return photo
 
     @staticmethod
     @trace
-    async def upload(node_id: int, user_id: int, file: UploadFile) -> Photo:
-        img = Image.open(file.file)
+    async def get_file_path(id: str) -> Path | None:
+        """
+        Get the file path of the photo, or None if it does not exist.
 
-        try:
-            ImageOps.exif_transpose(img, in_place=True)
-        except Exception:
-            file.file.seek(0)
-            add_attachment(
-                file.file.read(),
-                filename=file.filename,
-                content_type=file.content_type,
-            )
-            raise
+        Photos never change after upload, so lookups are served from the in-memory index,
+        then from the shared Valkey index, and only then from the database.
+        Only indexed photos have their files, removals go through delete or the periodic rebuild.
+        """
+        path = _PHOTO_INDEX.get(id)
+        if path is not None:
+            return path
+
+        async with valkey() as conn:
+            name: bytes | None = await conn.hget(_PHOTO_INDEX_KEY, id)
+
+        if name is not None:
+            path = PHOTOS_DIR / name.decode()
+        else:
+            photo = await PhotoService.get_by_id(id)
+            if photo is None:
+                return None
+            path = photo.file_path
+            await _add_to_index(id, path)
+
+        _PHOTO_INDEX[id] = path
+        return path
+
+    @staticmethod
+    @trace
+    async def delete(id: str) -> None:
+        """
+        Delete the photo, its reports and files, and remove it from the index.
+        """
+        async with db_write() as session:
+            photo = await session.get(Photo, id)
+            if photo is None:
+                return
+            await session.execute(delete(PhotoReport).where(PhotoReport.photo_id == id))
+            await session.delete(photo)
+
+        await _remove_from_index(id)
+        await photo_storage.delete(photo.file_path)
+
+    @staticmethod
+    async def build_index_task() -> NoReturn:
+        """
+        Periodically rebuild the photo index, dropping the photos whose files were removed outside the app.
+        """
+        while True:
+            await sleep(PHOTO_INDEX_REBUILD_INTERVAL.total_seconds())
+            with start_transaction(op='photo.index', name=PhotoService.build_index_task.__qualname__):
+                try:
+                    await PhotoService.build_index()
+                except Exception:
+                    # lookups keep using the previous index
+                    logging.warning('Failed to rebuild photo index', exc_info=True)
+
+    @staticmethod
+    @trace
+    async def build_index() -> None:
+        """
+        Rebuild the photo index from the database and the existing files.
+        """
+        async with db_read() as session:
+            photos = (await session.scalars(select(Photo))).all()
+
+        names = await photo_storage.list_photos()
+        index = {
+            photo.id: name for photo in photos if (name := photo.file_path.relative_to(PHOTOS_DIR).as_posix()) in names
+        }
+
+        async with valkey() as conn, conn.pipeline() as pipe:
+            pipe.delete(_PHOTO_INDEX_KEY)
+            if index:
+                pipe.hset(_PHOTO_INDEX_KEY, mapping=index)
+            await pipe.execute()
+
+        _PHOTO_INDEX.clear()
+        _PHOTO_INDEX.update((id, PHOTOS_DIR / name) for id, name in index.items())
+        logging.info('Indexed %d photos', len(index))
+
+    @staticmethod
+    @trace
+    async def get_thumbnail_path(file_path: Path, width: int) -> Path:
+        """
+        Get the path of the photo scaled down to the given width, generating it on first use.
+
+        Photos that are not wider than the requested width are served as they are.
+        Raises a 503 error when too many thumbnails are being generated.
+        """
+        path = photo_storage.get_thumbnail_path(file_path, width)
+        if await photo_storage.is_file(path):
+            return path
+
+        async with _THUMBNAIL_QUEUE.slot():
+            # generated by another request while waiting
+            if await photo_storage.is_file(path):
+                return path
+
+            thumbnail = await _run_processing(_make_thumbnail, file_path, width)
+            if thumbnail is None:
+                return file_path
+
+            await photo_storage.write(path, thumbnail)
+            return path
 
-        img = _resize_image(img)
-        img_bytes = _optimize_quality(img)
+    @staticmethod
+    @trace
+    async def upload(node_id: int, user_id: int, file: UploadFile) -> Photo:
+        async with _UPLOAD_QUEUE.slot():
+            try:
+                img = await _run_processing(_open_image, file.file)
+            except Exception:
+                file.file.seek(0)
+                add_attachment(
+                    file.file.read(),
+                    filename=file.filename,
+                    content_type=file.content_type,
+                )
+                raise
+
+            img = await _run_processing(_resize_image, img)
+            img_bytes = await _optimize_quality(img)
 
         async with db_write() as session:
             photo = Photo(
@@ -50,62 +239,149 @@ class PhotoService:
             )
             session.add(photo)
 
-        photo.file_path.write_bytes(img_bytes)
+        await photo_storage.write(photo.file_path, img_bytes)
+        await _add_to_index(photo.id, photo.file_path)
         return photo
 
+    @staticmethod
+    @trace
+    async def transcode(data: bytes) -> bytes | None:
+        """
+        Downscale and re-encode a remote image as a WebP suited for display.
+
+        Returns None without waiting when other images are already being transcoded.
+        """
+        if _TRANSCODE_SLOTS.locked():
+            return None
+
+        async with _TRANSCODE_SLOTS:
+            img = await _run_processing(_open_image, BytesIO(data))
+            img = await _run_processing(_resize_image, img, IMAGE_PROXY_LIMIT_PIXELS)
+            return await _optimize_quality(img, IMAGE_PROXY_MAX_FILE_SIZE)
+
+
+async def _add_to_index(id: str, path: Path) -> None:
+    async with valkey() as conn:
+        await conn.hset(_PHOTO_INDEX_KEY, id, path.relative_to(PHOTOS_DIR).as_posix())
+
+
+async def _remove_from_index(id: str) -> None:
+    _PHOTO_INDEX.pop(id, None)
+    async with valkey() as conn:
+        await conn.hdel(_PHOTO_INDEX_KEY, id)
+
+
+async def _run_processing(func, *args):
+    return await get_running_loop().run_in_executor(_PROCESSING_EXECUTOR, func, *args)
+
+
+def _make_thumbnail(path: Path, width: int) -> bytes | None:
+    with Image.open(path) as img:
+        if img.width <= width:
+            return None
+
+        height = max(round(img.height * width / img.width), 1)
+        thumbnail = img.resize((width, height), Image.Resampling.LANCZOS)
+
+    with BytesIO() as buffer:
+        thumbnail.save(buffer, format='WEBP', quality=IMAGE_THUMBNAIL_QUALITY)
+        return buffer.getvalue()
+
+
+def _open_image(file: BinaryIO) -> Image.Image:
+    img = Image.open(file)
+    ImageOps.exif_transpose(img, in_place=True)
+    img.load()
+
+    # palette, bilevel and 16-bit images cannot be reduced, and WebP converts them anyway
+    if img.mode in {'P', 'PA', '1'} or img.mode.startswith('I;16'):
+        img = img.convert('RGBA' if img.has_transparency_data else 'RGB')
+
+    return img
+
 
 @trace
-def _resize_image(img: Image.Image) -> Image.Image:
+def _resize_image(img: Image.Image, limit_pixels: int = IMAGE_LIMIT_PIXELS) -> Image.Image:
     width, height = img.size
-    if width * height <= IMAGE_LIMIT_PIXELS:
+    if width * height <= limit_pixels:
         return img
 
-    ratio = (IMAGE_LIMIT_PIXELS / (width * height)) ** 0.5
+    ratio = (limit_pixels / (width * height)) ** 0.5
     new_width = int(width * ratio)
     new_height = int(height * ratio)
     return img.resize((new_width, new_height), Image.Resampling.LANCZOS)
 
 
 @trace
-def _optimize_quality(img: Image.Image) -> bytes:
-    high, low = 95, 20
-    bs_step = 5
+async def _optimize_quality(img: Image.Image, max_file_size: int = IMAGE_MAX_FILE_SIZE) -> bytes:
+    """
+    Encode the image with the highest quality (in steps of 5) that fits within the file size limit.
+
+    Full-resolution sizes are predicted from cheap encodes of a downscaled proxy, which capture
+    the image complexity. Each full encode calibrates the proxy-to-full size ratio, and the search
+    only settles once the next quality step up was encoded and found too big, so a pessimistic
+    prediction cannot hide a better quality. This usually takes two full encodes.
+    """
+    proxy = await _run_processing(_make_proxy, img)
+    proxy_buffers = await gather(*(_run_processing(_encode_webp_copy, proxy, quality) for quality in _QUALITIES))
+    proxy_sizes = {quality: len(buffer) for quality, buffer in zip(_QUALITIES, proxy_buffers, strict=True)}
+
+    if proxy is img:
+        # small image, the proxy encodes are the final ones
+        for buffer in proxy_buffers:
+            if len(buffer) <= max_file_size:
+                return buffer
+        raise ValueError('Image is too big')
+
+    # before the first full encode, assume the size scales with the pixel count
+    size_ratio = (img.width * img.height) / (proxy.width * proxy.height)
+    best_quality = 0
     best_buffer = None
+    too_big_quality = 100
 
-    with BytesIO() as buffer:
-        # initial quick scan
-        for quality in (80, 60, 40, 20):
-            buffer.seek(0)
-            buffer.truncate()
-
-            img.save(buffer, format='WEBP', quality=quality)
-            size = buffer.tell()
-            logging.debug('Optimizing avatar quality (quick): Q%d -> %.2fMB', quality, size / 1024 / 1024)
-
-            if size > IMAGE_MAX_FILE_SIZE:
-                high = quality - bs_step
-            else:
-                low = quality + bs_step
-                best_buffer = buffer.getvalue()
-                break
+    while True:
+        candidates = [
+            quality
+            for quality in _QUALITIES
+            if best_quality < quality < too_big_quality and proxy_sizes[quality] * size_ratio <= max_file_size
+        ]
+        if candidates:
+            quality = max(candidates)
+        elif best_buffer is not None:
+            # no step up is predicted to fit, verify that before settling
+            if best_quality + 5 >= too_big_quality:
+                return best_buffer
+            quality = best_quality + 5
+        elif too_big_quality > _QUALITIES[-1]:
+            # nothing is predicted to fit, verify the lowest quality
+            quality = _QUALITIES[-1]
         else:
             raise ValueError('Image is too big')
 
-        # fine-tune with binary search
-        while low <= high:
-            quality = ((low + high) // 2) // bs_step * bs_step
+        buffer = await _run_processing(_encode_webp, img, quality)
+        size = len(buffer)
+        size_ratio = size / proxy_sizes[quality]
+        logging.debug('Optimizing avatar quality: Q%d -> %.2fMB', quality, size / 1024 / 1024)
 
-            buffer.seek(0)
-            buffer.truncate()
+        if size > max_file_size:
+            too_big_quality = quality
+        else:
+            best_quality = quality
+            best_buffer = buffer
+
+
+def _make_proxy(img: Image.Image) -> Image.Image:
+    factor = ceil(((img.width * img.height) / _PROXY_MAX_PIXELS) ** 0.5)
+    return img.reduce(factor) if factor > 1 else img
 
-            img.save(buffer, format='WEBP', quality=quality)
-            size = buffer.tell()
-            logging.debug('Optimizing avatar quality (fine): Q%d -> %.2fMB', quality, size / 1024 / 1024)
 
-            if size > IMAGE_MAX_FILE_SIZE:
-                high = quality - bs_step
-            else:
-                low = quality + bs_step
-                best_buffer = buffer.getvalue()
+def _encode_webp(img: Image.Image, quality: int) -> bytes:
+    with BytesIO() as buffer:
+        img.save(buffer, format='WEBP', quality=quality)
+        return buffer.getvalue()
+
 
-        return best_buffer
+def _encode_webp_copy(img: Image.Image, quality: int) -> bytes:
+    # save() stores the encoder options on the image, so concurrent probes each work on a copy,
+    # which is cheap for proxies; full-size encodes run one at a time and skip it
+    return _encode_webp(img.copy(), quality)
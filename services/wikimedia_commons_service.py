@@ -0,0 +1,145 @@
+import logging
+from asyncio import Lock
+from collections.abc import Collection
+
+from sentry_sdk import trace
+
+from config import (
+    WIKIMEDIA_COMMONS_API_URL,
+    WIKIMEDIA_COMMONS_CACHE_EXPIRE,
+    WIKIMEDIA_COMMONS_MISSING_CACHE_EXPIRE,
+    WIKIMEDIA_COMMONS_PREWARM_EXPIRE,
+    WIKIMEDIA_COMMONS_THUMBNAIL_WIDTH,
+)
+from db import valkey
+from utils import HTTP
+
+_BATCH_SIZE = 50  # max titles per query for regular API users
+_PREWARM_LOCK = Lock()
+
+
+class WikimediaCommonsService:
+    @staticmethod
+    @trace
+    async def get_image_url(title: str, width: int = WIKIMEDIA_COMMONS_THUMBNAIL_WIDTH) -> str | None:
+        """
+        Get the URL of the file scaled down to the given width, or None if there is no such file.
+        """
+        return (await WikimediaCommonsService.get_image_urls((title,), width))[title]
+
+    @staticmethod
+    @trace
+    async def get_image_urls(
+        titles: Collection[str], width: int = WIKIMEDIA_COMMONS_THUMBNAIL_WIDTH
+    ) -> dict[str, str | None]:
+        """
+        Get the URLs of the files scaled down to the given width.
+
+        Resolutions are cached in Valkey, the uncached files are queried from the imageinfo API in batches.
+        """
+        titles = tuple(dict.fromkeys(titles))
+        if not titles:
+            return {}
+
+        async with valkey() as conn:
+            values: list[bytes | None] = await conn.mget([_cache_key(title, width) for title in titles])
+
+        result: dict[str, str | None] = {}
+        uncached: list[str] = []
+
+        for title, value in zip(titles, values, strict=True):
+            if value is None:
+                uncached.append(title)
+            else:
+                result[title] = value.decode() or None
+
+        if not uncached:
+            return result
+
+        # the API etiquette asks for serial requests
+        resolved: dict[str, str | None] = {}
+        for i in range(0, len(uncached), _BATCH_SIZE):
+            resolved.update(await _query_image_urls(uncached[i : i + _BATCH_SIZE], width))
+
+        async with valkey() as conn, conn.pipeline(transaction=False) as pipe:
+            for title, url in resolved.items():
+                # missing files are cached briefly, they may be uploaded soon
+                pipe.set(
+                    _cache_key(title, width),
+                    url or '',
+                    ex=WIKIMEDIA_COMMONS_CACHE_EXPIRE if url else WIKIMEDIA_COMMONS_MISSING_CACHE_EXPIRE,
+                )
+            await pipe.execute()
+
+        logging.debug('Resolved %d Wikimedia Commons files', len(resolved))
+        result.update(resolved)
+        return result
+
+    @staticmethod
+    async def prewarm(titles: Collection[str]) -> None:
+        """
+        Resolve the files ahead of their first use, ignoring failures.
+
+        Titles are claimed in Valkey first, so tile requests across all workers resolve each file once,
+        and prewarms run one at a time per process.
+        """
+        titles = tuple(dict.fromkeys(titles))
+
+        try:
+            async with valkey() as conn, conn.pipeline(transaction=False) as pipe:
+                for title in titles:
+                    pipe.set(f'commons-prewarm:{title}', b'', nx=True, ex=WIKIMEDIA_COMMONS_PREWARM_EXPIRE)
+                claimed = [title for title, is_set in zip(titles, await pipe.execute(), strict=True) if is_set]
+
+            if not claimed:
+                return
+
+            async with _PREWARM_LOCK:
+                await WikimediaCommonsService.get_image_urls(claimed)
+        except Exception:
+            logging.warning('Failed to prewarm %d Wikimedia Commons files', len(titles), exc_info=True)
+
+
+def _cache_key(title: str, width: int) -> str:
+    return f'commons:{width}:{title}'
+
+
+async def _query_image_urls(titles: Collection[str], width: int) -> dict[str, str | None]:
+    r = await HTTP.get(
+        WIKIMEDIA_COMMONS_API_URL,
+        params={
+            'action': 'query',
+            'format': 'json',
+            'formatversion': '2',
+            'prop': 'imageinfo',
+            'iiprop': 'url',
+            'iiurlwidth': width,
+            'redirects': '1',
+            # the separator is not allowed in titles, such titles are missing anyway
+            'titles': '|'.join(title for title in titles if '|' not in title),
+        },
+    )
+    r.raise_for_status()
+    data: dict = r.json()
+
+    if (error := data.get('error')) is not None:
+        raise ValueError(f'Wikimedia Commons API error: {error.get("info")}')
+
+    query: dict = data.get('query', {})
+    normalized = {item['from']: item['to'] for item in query.get('normalized', ())}
+    redirects = {item['from']: item['to'] for item in query.get('redirects', ())}
+    urls: dict[str, str] = {}
+
+    for page in query.get('pages', ()):
+        if imageinfo := page.get('imageinfo'):
+            # files narrower than the requested width have no thumbnail
+            urls[page['title']] = imageinfo[0].get('thumburl') or imageinfo[0]['url']
+
+    result: dict[str, str | None] = {}
+
+    for title in titles:
+        page_title = normalized.get(title, title)
+        page_title = redirects.get(page_title, page_title)
+        result[title] = urls.get(page_title)
+
+    return result
@@ -51,6 +51,9 @@ let
     '')
     (writeShellScriptBin "alembic-upgrade" "alembic -c config/alembic.ini upgrade head")
 
+    # -- Data
+    (writeShellScriptBin "aed-import" "python aed_import.py \"$@\"")
+
     # -- Supervisor
     (writeShellScriptBin "dev-start" ''
       set -e
@@ -1,8 +1,11 @@
 import logging
+import os
 import time
 from asyncio import sleep
 from datetime import timedelta
 from functools import wraps
+from pathlib import Path
+from tempfile import NamedTemporaryFile
 
 from httpx import AsyncClient, Timeout
 from httpx_secure import httpx_ssrf_protection
@@ -47,6 +50,67 @@ def retry_exponential(timeout: timedelta | float | None, *, start: float = 1):
     return decorator
 
 
+def write_atomic(path: Path, data: bytes) -> None:
+    """
+    Write the file through a temporary file, so readers never see partial content.
+
+    The data is synced to disk before the rename, so a crash cannot leave an empty file behind.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    with NamedTemporaryFile(dir=path.parent, prefix=f'.{path.name}.', delete=False) as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    temp_path = Path(f.name)
+
+    try:
+        # temporary files are private to the owner, but e.g. photos may be served by a separate static file server
+        temp_path.chmod(0o644)
+        temp_path.replace(path)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+
+def prune_cache(directory: Path, max_size: int) -> int:
+    """
+    Remove the least recently used files until the directory fits within the size limit.
+
+    Dot-prefixed files are temporary files still being written, and are left alone.
+    Returns the number of removed files.
+    """
+    files: list[tuple[float, int, Path]] = []
+    total_size = 0
+
+    for path in directory.rglob('*'):
+        if path.name.startswith('.'):
+            continue
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        if not path.is_file():
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+        total_size += stat.st_size
+
+    if total_size <= max_size:
+        return 0
+
+    files.sort(key=lambda x: x[0])
+    removed = 0
+
+    for _, size, path in files:
+        path.unlink(missing_ok=True)
+        total_size -= size
+        removed += 1
+        if total_size <= max_size:
+            break
+
+    return removed
+
+
 def abbreviate(num: int) -> str:
     for suffix, divisor in (('m', 1_000_000), ('k', 1_000)):
         if num >= divisor:
@@ -54,5 +118,13 @@ def abbreviate(num: int) -> str:
     return str(num)
 
 
+def get_wikimedia_commons_title(tags: dict[str, str]) -> str | None:
+    """
+    Get the Wikimedia Commons page referenced by the tags, if any.
+    """
+    title = tags.get('wikimedia_commons', '').partition(';')[0]
+    return title if title and title[:4].casefold() != 'http' else None
+
+
 def get_wikimedia_commons_url(path: str) -> str:
     return f'https://commons.wikimedia.org/wiki/{path}'